@@ -13,6 +13,7 @@ from generative_agents.memory_utils import *
 from transformers import BlipProcessor, BlipForConditionalGeneration
 from PIL import Image
 from global_methods import run_chatgpt, run_chatgpt_with_examples, set_openai_key
+from llm_cache import print_llm_cache_stats
 
 logging.basicConfig(level=logging.INFO)
 
@@ -601,6 +602,7 @@ def main():
 
     agent_a, agent_b = load_agents(args)
     convert_to_chat_html(agent_a, agent_b, outfile=os.path.join(args.out_dir, 'sessions.html'), use_events=args.events, img_dir=args.out_dir)
+    print_llm_cache_stats()
 
 
 if __name__ == "__main__":
@@ -1,43 +1,101 @@
-import openai
 import numpy as np
 import json
 import time
 import sys
 import os
 
-import google.generativeai as genai
-from anthropic import Anthropic
+from llm_cache import cached_completion
+
+# the SDKs of the API providers are imported by the functions that call them, so that loading
+# this module does not import the SDKs of backends that are not used
+
+EMBEDDING_MAX_INPUTS_PER_REQUEST = 2048
+EMBEDDING_MAX_TOKENS_PER_REQUEST = 100000
+
+
+def get_embedding_chunks(texts, model, max_inputs=EMBEDDING_MAX_INPUTS_PER_REQUEST, max_tokens=EMBEDDING_MAX_TOKENS_PER_REQUEST):
+
+    # split input indices into requests that respect the per-request input and token limits
+    try:
+        import tiktoken
+        encoding = tiktoken.encoding_for_model(model)
+        count_tokens = lambda text: len(encoding.encode(text))
+    except Exception:
+        count_tokens = lambda text: len(text) // 4 + 1
+
+    chunks = []
+    chunk = []
+    chunk_tokens = 0
+    for i, text in enumerate(texts):
+        num_tokens = count_tokens(text)
+        if chunk and (len(chunk) == max_inputs or chunk_tokens + num_tokens > max_tokens):
+            chunks.append(chunk)
+            chunk = []
+            chunk_tokens = 0
+        chunk.append(i)
+        chunk_tokens += num_tokens
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+
+def run_openai_embedding(texts, model="text-embedding-ada-002", wait_time=1, max_trials=5):
+
+    import openai
+    trials = 0
+    while True:
+        trials += 1
+        wait_time = wait_time * 2
+        try:
+            response = openai.Embedding.create(input=texts, model=model)
+            # the API may return items out of order; each carries the position of its input
+            return [item['embedding'] for item in sorted(response['data'], key=lambda item: item['index'])]
+        except (openai.error.APIError, openai.error.APIConnectionError, openai.error.RateLimitError,
+                openai.error.ServiceUnavailableError, openai.error.Timeout) as e:
+            if trials == max_trials:
+                raise
+            print(f"OpenAI embedding request failed: {e}; waiting for {wait_time} seconds (trial {trials}/{max_trials})")
+            time.sleep(wait_time)
 
 
 def get_openai_embedding(texts, model="text-embedding-ada-002"):
-   texts = [text.replace("\n", " ") for text in texts]
-   return np.array([openai.Embedding.create(input = texts, model=model)['data'][i]['embedding'] for i in range(len(texts))])
+    texts = [text.replace("\n", " ") for text in texts]
+    embeddings = []
+    # each chunk is sent once and retried on its own if it fails
+    for chunk in get_embedding_chunks(texts, model):
+        embeddings.extend(run_openai_embedding([texts[i] for i in chunk], model=model))
+    return np.array(embeddings)
 
 def set_anthropic_key():
     pass
 
 def set_gemini_key():
 
+    import google.generativeai as genai
     # Or use `os.getenv('GOOGLE_API_KEY')` to fetch an environment variable.
     genai.configure(api_key=os.environ['GOOGLE_API_KEY'])
 
 def set_openai_key():
+    import openai
     openai.api_key = os.environ['OPENAI_API_KEY']
 
 
 def run_json_trials(query, num_gen=1, num_tokens_request=1000, 
                 model='davinci', use_16k=False, temperature=1.0, wait_time=1, examples=None, input=None):
 
+    # retries skip the LLM cache, which would otherwise return the same unparsable output
     run_loop = True
     counter = 0
     while run_loop:
         try:
             if examples is not None and input is not None:
                 output = run_chatgpt_with_examples(query, examples, input, num_gen=num_gen, wait_time=wait_time,
-                                                   num_tokens_request=num_tokens_request, use_16k=use_16k, temperature=temperature).strip()
+                                                   num_tokens_request=num_tokens_request, use_16k=use_16k, temperature=temperature,
+                                                   refresh=counter > 0).strip()
             else:
                 output = run_chatgpt(query, num_gen=num_gen, wait_time=wait_time, model=model,
-                                                   num_tokens_request=num_tokens_request, use_16k=use_16k, temperature=temperature)
+                                                   num_tokens_request=num_tokens_request, use_16k=use_16k, temperature=temperature,
+                                                   refresh=counter > 0)
             output = output.replace('json', '') # this frequently happens
             facts = json.loads(output.strip())
             run_loop = False
@@ -54,7 +112,14 @@ def run_json_trials(query, num_gen=1, num_tokens_request=1000,
 
 
 def run_claude(query, max_new_tokens, model_name):
+    # no temperature is passed, so the API samples at its default of 1.0
+    return cached_completion('anthropic', model_name, query, {'max_tokens': max_new_tokens, 'temperature': 1.0},
+                             lambda: request_claude(query, max_new_tokens, model_name))
 
+
+def request_claude(query, max_new_tokens, model_name):
+
+    from anthropic import Anthropic
     if model_name == 'claude-sonnet':
         model_name = "claude-3-sonnet-20240229"
     elif model_name == 'claude-haiku':
@@ -75,11 +140,16 @@ def run_claude(query, max_new_tokens, model_name):
         ],
         model=model_name,
     )
-    print(message.content)
     return message.content[0].text
 
 
 def run_gemini(model, content: str, max_tokens: int = 0):
+    # generation config of the model is left at its (sampled) defaults
+    return cached_completion('gemini', getattr(model, 'model_name', str(model)), content, {'temperature': None},
+                             lambda: request_gemini(model, content))
+
+
+def request_gemini(model, content: str):
 
     try:
         response = model.generate_content(content)
@@ -90,8 +160,15 @@ def run_gemini(model, content: str, max_tokens: int = 0):
 
 
 def run_chatgpt(query, num_gen=1, num_tokens_request=1000, 
-                model='chatgpt', use_16k=False, temperature=1.0, wait_time=1):
+                model='chatgpt', use_16k=False, temperature=1.0, wait_time=1, refresh=False):
+    return cached_completion('openai', model, query, {'num_gen': num_gen, 'max_tokens': num_tokens_request, 'temperature': temperature},
+                             lambda: request_chatgpt(query, num_gen, num_tokens_request, model, temperature, wait_time),
+                             refresh=refresh)
 
+
+def request_chatgpt(query, num_gen=1, num_tokens_request=1000, model='chatgpt', temperature=1.0, wait_time=1):
+
+    import openai
     completion = None
     while completion is None:
         wait_time = wait_time * 2
@@ -167,10 +244,8 @@ def run_chatgpt(query, num_gen=1, num_tokens_request=1000,
         return completion.choices[0].message.content
     
 
-def run_chatgpt_with_examples(query, examples, input, num_gen=1, num_tokens_request=1000, use_16k=False, wait_time = 1, temperature=1.0):
+def run_chatgpt_with_examples(query, examples, input, num_gen=1, num_tokens_request=1000, use_16k=False, wait_time = 1, temperature=1.0, refresh=False):
 
-    completion = None
-    
     messages = [
         {"role": "system", "content": query}
     ]
@@ -184,12 +259,21 @@ def run_chatgpt_with_examples(query, examples, input, num_gen=1, num_tokens_requ
     messages.append(
         {"role": "user", "content": input}
     )   
-    
+    model = "gpt-3.5-turbo" if not use_16k else "gpt-3.5-turbo-16k"
+    return cached_completion('openai', model, messages, {'num_gen': num_gen, 'max_tokens': num_tokens_request, 'temperature': temperature},
+                             lambda: request_chatgpt_messages(messages, model, num_gen, num_tokens_request, temperature, wait_time),
+                             refresh=refresh)
+
+
+def request_chatgpt_messages(messages, model, num_gen=1, num_tokens_request=1000, temperature=1.0, wait_time=1):
+
+    import openai
+    completion = None
     while completion is None:
         wait_time = wait_time * 2
         try:
             completion = openai.ChatCompletion.create(
-                model="gpt-3.5-turbo" if not use_16k else "gpt-3.5-turbo-16k",
+                model=model,
                 temperature = temperature,
                 max_tokens = num_tokens_request,
                 n=num_gen,
@@ -0,0 +1,140 @@
+import os, json
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+# On-disk cache of LLM completions shared by all backends in global_methods.py.
+# Configured through environment variables, like the API keys:
+#   LLM_CACHE_FILE     sqlite file (default ~/.cache/locomo/llm_cache.sqlite); empty string disables the cache
+#   LLM_CACHE_MAX_MB   size budget of the cached completions; least recently used entries are evicted first
+#   LLM_CACHE_SAMPLED  set to 1 to also serve calls with temperature > 0 from the cache
+# Only deterministic calls (temperature 0) are served by default.
+
+DEFAULT_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'locomo', 'llm_cache.sqlite')
+DEFAULT_MAX_MB = 1024
+EVICT_TO = 0.9 # fraction of the budget kept after an eviction
+
+_CACHE = None
+
+
+def get_cache_key(backend, model, prompt, params):
+    # prompt can be a string or a list of messages; params holds every decoding argument of the call
+    payload = json.dumps([backend, model, params], sort_keys=True)
+    prompt = prompt if isinstance(prompt, str) else json.dumps(prompt, sort_keys=True)
+    return hashlib.sha256((payload + '\n' + prompt).encode('utf-8')).hexdigest()
+
+
+class LLMCache(object):
+    """
+    Content-addressed completion cache in a sqlite file. Entries store the JSON-encoded output
+    of a call; size-based eviction drops the least recently read entries.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_MB * 1024 * 1024, cache_sampled=False):
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.cache_sampled = cache_sampled
+        self.hits = 0
+        self.misses = 0
+        # calls run on several threads (see task_eval/scheduler_utils.py)
+        self.lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, value TEXT, size INTEGER, last_access REAL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS completions_last_access ON completions (last_access)')
+        self.conn.commit()
+        self.total_bytes = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM completions').fetchone()[0]
+
+    def get(self, key):
+
+        with self.lock:
+            row = self.conn.execute('SELECT value FROM completions WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.conn.execute('UPDATE completions SET last_access = ? WHERE key = ?', (time.time(), key))
+            self.conn.commit()
+        return json.loads(row[0])
+
+    def put(self, key, output):
+
+        value = json.dumps(output)
+        size = len(value.encode('utf-8'))
+        with self.lock:
+            old = self.conn.execute('SELECT size FROM completions WHERE key = ?', (key,)).fetchone()
+            self.conn.execute('INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?)', (key, value, size, time.time()))
+            self.total_bytes += size - (old[0] if old else 0)
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+
+        # other processes may share the file, so recount before deleting
+        self.total_bytes = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM completions').fetchone()[0]
+        target = self.total_bytes - int(self.max_bytes * EVICT_TO)
+        if target <= 0:
+            return
+        freed = 0
+        keys = []
+        for key, size in self.conn.execute('SELECT key, size FROM completions ORDER BY last_access'):
+            keys.append((key,))
+            freed += size
+            if freed >= target:
+                break
+        self.conn.executemany('DELETE FROM completions WHERE key = ?', keys)
+        self.total_bytes -= freed
+
+    def stats(self):
+        with self.lock:
+            num_entries = self.conn.execute('SELECT COUNT(*) FROM completions').fetchone()[0]
+        return {'hits': self.hits, 'misses': self.misses, 'entries': num_entries, 'bytes': self.total_bytes}
+
+
+def get_llm_cache():
+
+    global _CACHE
+    if _CACHE is None:
+        path = os.environ.get('LLM_CACHE_FILE', DEFAULT_CACHE_FILE)
+        if not path:
+            return None
+        _CACHE = LLMCache(path,
+                          max_bytes=int(float(os.environ.get('LLM_CACHE_MAX_MB', DEFAULT_MAX_MB)) * 1024 * 1024),
+                          cache_sampled=os.environ.get('LLM_CACHE_SAMPLED', '0') == '1')
+    return _CACHE
+
+
+def cached_completion(backend, model, prompt, params, run, refresh=False):
+    """
+    Returns the cached output of a call if there is one, otherwise run() and caches its result.
+    A call is deterministic if params['temperature'] == 0; other calls bypass the cache unless
+    LLM_CACHE_SAMPLED=1. Failed calls (None) are not cached. refresh=True skips the lookup and
+    replaces the cached output, e.g. when a retry rejected it.
+    """
+
+    cache = get_llm_cache()
+    if cache is None or (params.get('temperature') != 0 and not cache.cache_sampled):
+        return run()
+
+    key = get_cache_key(backend, model, prompt, params)
+    output = None if refresh else cache.get(key)
+    if output is not None:
+        return output
+
+    output = run()
+    if output is not None:
+        cache.put(key, output)
+    return output
+
+
+def print_llm_cache_stats():
+    if _CACHE is not None:
+        stats = _CACHE.stats()
+        print("LLM cache: %s hits, %s misses, %s entries (%.1f MB)" % (stats['hits'], stats['misses'], stats['entries'], stats['bytes'] / (1024 * 1024)))
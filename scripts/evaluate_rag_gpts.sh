@@ -3,26 +3,20 @@ source scripts/env.sh
 
 # Evaluate gpt-3.5-turbo under different RAG conditions
 
-# dialog as database
-for TOP_K in 5 10 25 50; do
-    python3 task_eval/evaluate_qa.py \
-        --data-file $DATA_FILE_PATH --out-file $OUT_DIR/$QA_OUTPUT_FILE \
-        --model gpt-3.5-turbo --batch-size 1 --use-rag --retriever dragon --top-k $TOP_K \
-        --emb-dir $EMB_DIR --rag-mode dialog
-done
+# dialog as database; all values of k are evaluated in one run with shared retrieval
+python3 task_eval/evaluate_qa.py \
+    --data-file $DATA_FILE_PATH --out-file $OUT_DIR/$QA_OUTPUT_FILE \
+    --model gpt-3.5-turbo --batch-size 1 --use-rag --retriever dragon --top-k 5 10 25 50 \
+    --emb-dir $EMB_DIR --rag-mode dialog
 
 # observation as database
-for TOP_K in 5 10 25 50; do
-    python3 task_eval/evaluate_qa.py \
-        --data-file $DATA_FILE_PATH --out-file $OUT_DIR/$QA_OUTPUT_FILE \
-        --model gpt-3.5-turbo --batch-size 1 --use-rag --retriever dragon --top-k $TOP_K \
-        --emb-dir $EMB_DIR --rag-mode observation
-done
+python3 task_eval/evaluate_qa.py \
+    --data-file $DATA_FILE_PATH --out-file $OUT_DIR/$QA_OUTPUT_FILE \
+    --model gpt-3.5-turbo --batch-size 1 --use-rag --retriever dragon --top-k 5 10 25 50 \
+    --emb-dir $EMB_DIR --rag-mode observation
 
 # summary as database
-for TOP_K in 2 5 10; do
-    python3 task_eval/evaluate_qa.py \
-        --data-file $DATA_FILE_PATH --out-file $OUT_DIR/$QA_OUTPUT_FILE \
-        --model gpt-3.5-turbo --batch-size 1 --use-rag --retriever dragon --top-k $TOP_K \
-        --emb-dir $EMB_DIR --rag-mode summary
-done
+python3 task_eval/evaluate_qa.py \
+    --data-file $DATA_FILE_PATH --out-file $OUT_DIR/$QA_OUTPUT_FILE \
+    --model gpt-3.5-turbo --batch-size 1 --use-rag --retriever dragon --top-k 2 5 10 \
+    --emb-dir $EMB_DIR --rag-mode summary
@@ -0,0 +1,8 @@
+# sets necessary environment variables
+source scripts/env.sh
+
+# recall@k, MRR and throughput of every retriever and rag mode, without any LLM calls
+python3 task_eval/evaluate_retrieval.py \
+    --data-file $DATA_FILE_PATH --out-file $OUT_DIR/retrieval_benchmark.json \
+    --retrievers bm25s bm25s-stem contriever dragon dpr hybrid \
+    --rag-modes dialog observation summary --top-k 1 5 10 25 50
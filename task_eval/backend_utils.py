@@ -0,0 +1,84 @@
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import os
+import importlib
+
+
+# QA backends of evaluate_qa.py. A backend module (and the SDK or torch stack it imports) is only
+# loaded when a model of that backend is evaluated.
+#
+# backend -> (module, init function, local). init(args) sets up keys, clients or models and returns
+# answer(data, out_data, prediction_key, args): API backends return QARequests for the scheduler,
+# local backends generate the answers in place and return out_data.
+BACKENDS = {'openai': ('task_eval.gpt_utils', 'init_gpt_backend', False),
+            'anthropic': ('task_eval.claude_utils', 'init_claude_backend', False),
+            'gemini': ('task_eval.gemini_utils', 'init_gemini_backend', False),
+            'hf': ('task_eval.hf_llm_utils', 'init_hf_backend', True)}
+
+# model -> backend
+MODEL_BACKENDS = {'gpt-3.5-turbo': 'openai',
+                  'gpt-3.5-turbo-4k': 'openai',
+                  'gpt-3.5-turbo-8k': 'openai',
+                  'gpt-3.5-turbo-12k': 'openai',
+                  'gpt-3.5-turbo-16k': 'openai',
+                  'gpt-4': 'openai',
+                  'gpt-4-32k': 'openai',
+                  'gpt-4-turbo': 'openai',
+                  'claude-sonnet': 'anthropic',
+                  'claude-haiku': 'anthropic',
+                  'gemini-pro-1.0': 'gemini',
+                  'llama2': 'hf',
+                  'llama2-70b': 'hf',
+                  'llama2-chat': 'hf',
+                  'llama2-chat-70b': 'hf',
+                  'llama3-chat-70b': 'hf',
+                  'mistral-7b-4k': 'hf',
+                  'mistral-7b-8k': 'hf',
+                  'mistral-7b-128k': 'hf',
+                  'mistral-instruct-7b-8k': 'hf',
+                  'mistral-instruct-7b-12k': 'hf',
+                  'mistral-instruct-7b-128k': 'hf',
+                  'mistral-instruct-7b-8k-new': 'hf',
+                  'mistral-instruct-7b-32k-v2': 'hf',
+                  'gemma-7b-it': 'hf'}
+
+# models that are not listed above (e.g. local checkpoints like ../models/Qwen/Qwen2.5-3B-Instruct)
+# are matched by the prefix of their last path component; --backend overrides both
+MODEL_FAMILY_BACKENDS = [('gpt-', 'openai'),
+                         ('claude-', 'anthropic'),
+                         ('gemini-', 'gemini'),
+                         ('qwen', 'hf'),
+                         ('mistral', 'hf'),
+                         ('llama', 'hf'),
+                         ('gemma', 'hf')]
+
+
+def get_backend_name(model, backend=None):
+
+    if backend:
+        if backend not in BACKENDS:
+            raise NotImplementedError("Unknown backend %s, choose from %s" % (backend, ', '.join(BACKENDS)))
+        return backend
+    if model in MODEL_BACKENDS:
+        return MODEL_BACKENDS[model]
+    name = os.path.basename(os.path.normpath(model)).lower()
+    for prefix, backend in MODEL_FAMILY_BACKENDS:
+        if name.startswith(prefix):
+            return backend
+    raise NotImplementedError("No backend is registered for model %s; add it to MODEL_BACKENDS or pass --backend" % model)
+
+
+def is_local_backend(backend):
+    return BACKENDS[backend][2]
+
+
+def load_backend(args):
+    """
+    Imports the backend of args.model (or args.backend) and returns its answer function.
+    """
+
+    module_name, init_name, _ = BACKENDS[get_backend_name(args.model, getattr(args, 'backend', None))]
+    module = importlib.import_module(module_name)
+    return getattr(module, init_name)(args)
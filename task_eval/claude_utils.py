@@ -5,11 +5,12 @@ sys.path.insert(0, str(Path(__file__).parent.parent))
 import random
 import os, json
 from tqdm import tqdm
-import time
-from global_methods import run_claude
+from functools import partial
+from global_methods import run_claude, set_anthropic_key
+from task_eval.context_utils import get_context_builder, API_LAYOUT
+from task_eval.data_utils import get_conversation
+from task_eval.scheduler_utils import QARequest
 
-
-from scipy.spatial import distance
 import numpy as np
 
 MAX_LENGTH={'claude-sonnet': 2000000, 'claude-haiku': 2000000}
@@ -78,59 +79,89 @@ def get_cat_5_answer(model_prediction, answer_key):
         return model_prediction
 
 
-def get_input_context(data, num_question_tokens, model, args):
-
-    query_conv = ''
-    stop = False
-    session_nums = [int(k.split('_')[-1]) for k in data.keys() if 'session' in k and 'date_time' not in k]
-    for i in range(min(session_nums), max(session_nums) + 1):
-        if 'session_%s' % i in data:
-            query_conv += "\n\n"
-            for dialog in data['session_%s' % i][::-1]:
-                turn = ''
-                turn = dialog['speaker'] + ' said, \"' + dialog['text'] + '\"' + '\n'
-                if "blip_caption" in dialog:
-                    turn += ' and shared %s.' % dialog["blip_caption"]
-                turn += '\n'
-        
-                # num_tokens = len(model.count_tokens('DATE: ' + data['session_%s_date_time' % i] + '\n' + 'CONVERSATION:\n' + turn))
-                # if (num_tokens + len(model.count_tokens(query_conv)) + num_question_tokens) < (MAX_LENGTH[args.model]-(PER_QA_TOKEN_BUDGET*(args.batch_size))): # 20 tokens assigned for answers
-                #     query_conv = turn + query_conv
-                # else:
-                #     min_session = i
-                #     stop = True
-                #     break
-
-                query_conv = turn + query_conv
-
-            query_conv = '\nDATE: ' + data['session_%s_date_time' % i] + '\n' + 'CONVERSATION:\n' + query_conv
-        if stop:
+def get_input_context(data):
+
+    # full conversation is rendered once and reused for every batch; no truncation for long-context models
+    return get_context_builder(data, None, API_LAYOUT).build()
+
+
+def run_claude_batch_query(query, num_tokens_request, model):
+
+    trials = 0
+    while trials < 5:
+        try:
+            trials += 1
+            # print("Trial %s" % trials)
+            # print("Trying with answer token budget = %s per question" % PER_QA_TOKEN_BUDGET)
+            answer = run_claude(query, num_tokens_request, model)
+            answer = answer.replace('\\"', "'").replace('json','').replace('`','').strip()
+            # try:
+            #     answers = json.loads(answer.strip())
+            # except:
+            answers = process_ouput(answer.strip())
             break
-        
-        # if min_session == -1:
-        #     print("Saved %s tokens in query conversation from full conversation" % len(model.count_tokens(query_conv)))
-        # else:
-        #     print("Saved %s conv. tokens + %s question tokens in query from %s out of %s sessions" % (len(model.count_tokens(query_conv)), num_question_tokens, max_session-min_session, max_session))
+        except json.decoder.JSONDecodeError:
+            pass
+    return answer
 
-    return query_conv
 
+def save_claude_answer(out_data, prediction_key, include_idxs, cat_5_answers, context_ids, answer):
+
+    if len(cat_5_answers) > 0:
+        answer = get_cat_5_answer(answer, cat_5_answers[0])
+
+    out_data['qa'][include_idxs[0]][prediction_key] = answer.strip()
+    if context_ids is not None:
+        out_data['qa'][include_idxs[0]][prediction_key + '_context'] = context_ids
+
+
+def save_claude_batch_answers(out_data, prediction_key, include_idxs, cat_5_idxs, cat_5_answers, answer):
+
+    for k, idx in enumerate(include_idxs):
+        try:
+            answers = process_ouput(answer.strip())
+            # answers = json.loads(answer.strip())
+            # data['qa'][idx]['%s_prediction' % args.model] = answers[k]['answer'].strip()
+            if k in cat_5_idxs:
+                predicted_answer = get_cat_5_answer(answers[str(k)], cat_5_answers[cat_5_idxs.index(k)])
+                out_data['qa'][idx][prediction_key] = predicted_answer
+            else:
+                try:
+                    out_data['qa'][idx][prediction_key] = str(answers[str(k)]).replace('(a)', '').replace('(b)', '').strip()
+                except:
+                    out_data['qa'][idx][prediction_key] = ', '.join([str(n) for n in list(answers[str(k)].values())])
+        except:
+            try:
+                answers = json.loads(answer.strip())
+                if k in cat_5_idxs:
+                    predicted_answer = get_cat_5_answer(answers[k], cat_5_answers[cat_5_idxs.index(k)])
+                    out_data['qa'][idx][prediction_key] = predicted_answer
+                else:
+                    out_data['qa'][idx][prediction_key] = answers[k].replace('(a)', '').replace('(b)', '').strip()
+            except:
+                if k in cat_5_idxs:
+                    predicted_answer = get_cat_5_answer(answer.strip(), cat_5_answers[cat_5_idxs.index(k)])
+                    out_data['qa'][idx][prediction_key] = predicted_answer
+                else:
+                    out_data['qa'][idx][prediction_key] = json.loads(answer.strip().replace('(a)', '').replace('(b)', '').split('\n')[k])[0]
+
+
+def get_claude_requests(in_data, out_data, prediction_key, args):
 
-def get_claude_answers(in_data, out_data, prediction_key, args):
 
     assert len(in_data['qa']) == len(out_data['qa']), (len(in_data['qa']), len(out_data['qa']))
 
     # start instruction prompt
-    speakers_names = list(set([d['speaker'] for d in in_data['conversation']['session_1']]))
+    speakers_names = get_conversation(in_data['conversation']).speaker_names
     start_prompt = CONV_START_PROMPT.format(speakers_names[0], speakers_names[1])
-    # start_tokens = model.count_tokens(start_prompt)
-    start_tokens =100
 
     if args.rag_mode:
         raise NotImplementedError
     else:
         context_database, query_vectors = None, None
 
-    for batch_start_idx in tqdm(range(0, len(in_data['qa']), args.batch_size), desc='Generating answers'):
+    requests = []
+    for batch_start_idx in range(0, len(in_data['qa']), args.batch_size):
 
         questions = []
         include_idxs = []
@@ -177,78 +208,41 @@ def get_claude_answers(in_data, out_data, prediction_key, args):
             raise NotImplementedError
         else:
             question_prompt =  QA_PROMPT_BATCH + "\n".join(["%s: %s" % (k, q) for k, q in enumerate(questions)])
-            # num_question_tokens = model.count_tokens(question_prompt)
-            num_question_tokens=100
-            query_conv = get_input_context(in_data['conversation'], num_question_tokens + start_tokens, None, args)
+            query_conv = get_input_context(in_data['conversation'])
             query_conv = start_prompt + query_conv
         
 
-        # print("%s tokens in query" % len(model.count_tokens(query_conv)))
-
-        if 'pro-1.0' in args.model:
-            time.sleep(5)
-
         if args.batch_size == 1:
 
             query = query_conv + '\n\n' + QA_PROMPT.format(questions[0]) if len(cat_5_idxs) == 0 else query_conv + '\n\n' + QA_PROMPT_CAT_5.format(questions[0])
-            answer = run_claude(query, PER_QA_TOKEN_BUDGET, args.model)
-            
-            if len(cat_5_idxs) > 0:
-                answer = get_cat_5_answer(answer, cat_5_answers[0])
-
-            out_data['qa'][include_idxs[0]][prediction_key] = answer.strip()
-            if args.use_rag:
-                out_data['qa'][include_idxs[0]][prediction_key + '_context'] = context_ids
+            requests.append(QARequest(partial(run_claude, query, PER_QA_TOKEN_BUDGET, args.model),
+                                      partial(save_claude_answer, out_data, prediction_key, include_idxs, cat_5_answers,
+                                              context_ids if args.use_rag else None),
+                                      len(query)//4 + PER_QA_TOKEN_BUDGET,
+                                      out_data=out_data, prediction_key=prediction_key, qa_idxs=include_idxs))
 
         else:
             # query = query_conv + '\n' + QA_PROMPT_BATCH + "\n".join(["QUESTION: %s" % q for q in questions])
             query = query_conv + '\n' + question_prompt
-            # print(query)
-            
-            trials = 0
-            while trials < 5:
-                try:
-                    trials += 1
-                    # print("Trial %s" % trials)
-                    # print("Sending query of %s tokens" % len(model.count_tokens(query)))
-                    # print("Trying with answer token budget = %s per question" % PER_QA_TOKEN_BUDGET)
-                    answer = run_claude(query, PER_QA_TOKEN_BUDGET * args.batch_size, args.model)
-                    answer = answer.replace('\\"', "'").replace('json','').replace('`','').strip()
-                    # try:
-                    #     answers = json.loads(answer.strip())
-                    # except:
-                    answers = process_ouput(answer.strip())
-                    break
-                except json.decoder.JSONDecodeError:
-                    pass
-            
-            for k, idx in enumerate(include_idxs):
-                try:
-                    answers = process_ouput(answer.strip())
-                    # answers = json.loads(answer.strip())
-                    # data['qa'][idx]['%s_prediction' % args.model] = answers[k]['answer'].strip()
-                    if k in cat_5_idxs:
-                        predicted_answer = get_cat_5_answer(answers[str(k)], cat_5_answers[cat_5_idxs.index(k)])
-                        out_data['qa'][idx][prediction_key] = predicted_answer
-                    else:
-                        try:
-                            out_data['qa'][idx][prediction_key] = str(answers[str(k)]).replace('(a)', '').replace('(b)', '').strip()
-                        except:
-                            out_data['qa'][idx][prediction_key] = ', '.join([str(n) for n in list(answers[str(k)].values())])
-                except:
-                    try:
-                        answers = json.loads(answer.strip())
-                        if k in cat_5_idxs:
-                            predicted_answer = get_cat_5_answer(answers[k], cat_5_answers[cat_5_idxs.index(k)])
-                            out_data['qa'][idx][prediction_key] = predicted_answer
-                        else:
-                            out_data['qa'][idx][prediction_key] = answers[k].replace('(a)', '').replace('(b)', '').strip()
-                    except:
-                        if k in cat_5_idxs:
-                            predicted_answer = get_cat_5_answer(answer.strip(), cat_5_answers[cat_5_idxs.index(k)])
-                            out_data['qa'][idx][prediction_key] = predicted_answer
-                        else:
-                            out_data['qa'][idx][prediction_key] = json.loads(answer.strip().replace('(a)', '').replace('(b)', '').split('\n')[k])[0]
+            requests.append(QARequest(partial(run_claude_batch_query, query, PER_QA_TOKEN_BUDGET * args.batch_size, args.model),
+                                      partial(save_claude_batch_answers, out_data, prediction_key, include_idxs, cat_5_idxs, cat_5_answers),
+                                      len(query)//4 + PER_QA_TOKEN_BUDGET * args.batch_size,
+                                      out_data=out_data, prediction_key=prediction_key, qa_idxs=include_idxs))
+
+    return requests
+
+
+def init_claude_backend(args):
+    # see task_eval/backend_utils.py
+    set_anthropic_key()
+    return get_claude_requests
+
+
+def get_claude_answers(in_data, out_data, prediction_key, args):
+
+    # serial execution; evaluate_qa.py runs the same requests through the concurrent scheduler
+    for request in tqdm(get_claude_requests(in_data, out_data, prediction_key, args), desc='Generating answers'):
+        request.finish(request.call())
 
     return out_data
 
@@ -0,0 +1,183 @@
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from bisect import bisect_left
+from collections import OrderedDict
+from datetime import datetime
+from task_eval.data_utils import get_conversation
+
+
+# Layouts reproduce the string each backend used to build by hand.
+# 'count' selects how the truncation loop measured the conversation so far:
+#   'string' -> tokens of the whole (partially built) conversation string (gpt_utils)
+#   'turns'  -> running sum of per-turn token counts (hf_llm_utils)
+GPT_LAYOUT = {'name': 'gpt', 'session_sep': '\n\n', 'header': 'DATE: {}\nCONVERSATION:\n', 'count': 'string'}
+HF_LAYOUT = {'name': 'hf', 'session_sep': '', 'header': '\nDATE: {}\nCONVERSATION:\n', 'count': 'turns'}
+API_LAYOUT = {'name': 'api', 'session_sep': '\n\n', 'header': '\nDATE: {}\nCONVERSATION:\n', 'count': 'string'}
+
+# header used when measuring whether a single turn still fits
+PROBE_HEADER = 'DATE: {}\nCONVERSATION:\n'
+
+# session dates in LoCoMo look like "1:56 pm on 8 May, 2023"
+DATE_TIME_FORMAT = '%I:%M %p on %d %B, %Y'
+DEDUP_SHINGLE_SIZE = 3
+
+MAX_CACHED_BUILDERS = 16
+_BUILDERS = OrderedDict()
+
+
+class ContextBuilder(object):
+    """
+    Builds the (truncated) conversation context for one conversation.
+
+    Every turn and session header is rendered and tokenized once. The truncation point for a
+    given budget is found by binary search over cumulative token counts instead of re-encoding
+    the growing context for every turn.
+    """
+
+    def __init__(self, conversation, encoding=None, layout=GPT_LAYOUT):
+
+        self.conversation = conversation # keeps id(conversation) valid while cached
+        self.encoding = encoding
+        self.layout = layout
+
+        # sessions in the order the original loop visits them: (header, probe header, turns)
+        self.parsed = get_conversation(conversation)
+        self.sessions = [(layout['header'].format(session.date_time), PROBE_HEADER.format(session.date_time),
+                          [turn.rendered() for turn in session.turns]) for session in self.parsed.sessions]
+
+        # turns in the order they are considered for inclusion (latest turn of each session first)
+        self.candidates = [(s, t) for s, (_, _, turns) in enumerate(self.sessions) for t in range(len(turns) - 1, -1, -1)]
+
+        self._full_context = None
+        self._probe_tokens = []
+        self._reach = []
+        if encoding is not None:
+            self._count_tokens()
+
+    def _count_tokens(self):
+
+        encode = self.encoding.encode
+        sep = self.layout['session_sep']
+        header_tokens = [len(encode(header)) for header, _, _ in self.sessions]
+
+        turn_total = 0
+        reach = 0
+        current_session = -1
+        for s, t in self.candidates:
+            _, probe_header, turns = self.sessions[s]
+            if s != current_session:
+                current_session = s
+                # conversation tokens contributed by completed sessions, excluding their turns
+                if self.layout['count'] == 'string':
+                    session_base = sum(header_tokens[:s]) + (len(encode(sep * (s + 1))) if sep else 0)
+                else:
+                    session_base = 0
+
+            probe = len(encode(probe_header + turns[t]))
+            self._probe_tokens.append(probe)
+            # running max keeps the array sorted so the first failing turn can be bisected
+            reach = max(reach, probe + turn_total + session_base)
+            self._reach.append(reach)
+            turn_total += self.parsed.sessions[s].turns[t].token_count(self.encoding)
+
+    def _render(self, k):
+        # conversation string right before candidate k is considered, without the header of its session
+        sep = self.layout['session_sep']
+        if k == len(self.candidates):
+            s, parts = len(self.sessions), []
+        else:
+            s, t = self.candidates[k]
+            parts = self.sessions[s][2][t + 1:]
+        for p in range(s - 1, -1, -1):
+            parts.append(self.sessions[p][0])
+            parts.extend(self.sessions[p][2])
+        return ''.join(parts) + sep * min(s + 1, len(self.sessions))
+
+    def _fits(self, k, limit):
+        return self._probe_tokens[k] + len(self.encoding.encode(self._render(k))) < limit
+
+    def full_context(self):
+        if self._full_context is None:
+            self._full_context = self._render(len(self.candidates))
+        return self._full_context
+
+    def build(self, num_question_tokens=0, max_length=None):
+        """
+        Returns the conversation truncated so that question + context stay below max_length.
+        Output is identical to the turn-by-turn loop previously used by each backend.
+        """
+
+        if self.encoding is None or max_length is None:
+            return self.full_context()
+
+        limit = max_length - num_question_tokens
+        k = bisect_left(self._reach, limit)
+
+        # summed token counts can differ from encoding the joined string by a merge at the
+        # boundaries, so confirm the truncation point against the exact encoding
+        if self.layout['count'] == 'string':
+            while k > 0 and not self._fits(k - 1, limit):
+                k -= 1
+            while k < len(self.candidates) and self._fits(k, limit):
+                k += 1
+
+        if k == len(self.candidates):
+            return self.full_context()
+        return self.sessions[self.candidates[k][0]][0] + self._render(k)
+
+
+def get_context_builder(conversation, encoding=None, layout=GPT_LAYOUT):
+
+    key = (id(conversation), id(encoding), layout['name'])
+    if key in _BUILDERS:
+        _BUILDERS.move_to_end(key)
+        return _BUILDERS[key]
+
+    builder = ContextBuilder(conversation, encoding, layout)
+    _BUILDERS[key] = builder
+    if len(_BUILDERS) > MAX_CACHED_BUILDERS:
+        _BUILDERS.popitem(last=False)
+    return builder
+
+
+def parse_date_time(date_time):
+    try:
+        return datetime.strptime(date_time.strip(), DATE_TIME_FORMAT)
+    except (ValueError, AttributeError):
+        return None
+
+
+def get_shingles(text, n=DEDUP_SHINGLE_SIZE):
+    words = text.lower().split()
+    return set([tuple(words[i:i + n]) for i in range(max(1, len(words) - n + 1))])
+
+
+def pack_by_token_budget(candidates, encoding, token_budget, dedup_threshold=0.9, chronological=False):
+    """
+    Greedily packs retrieved candidates into token_budget tokens.
+
+    candidates are dicts with 'text' and optionally 'date_time' and 'position' (index in the
+    retrieval corpus), in decreasing score order. A candidate is skipped if it does not fit in
+    the remaining budget, or if the Jaccard similarity of its word shingles with an already
+    packed candidate is at least dedup_threshold. With chronological=True the packed candidates
+    are returned in date_time order (ties and unparsable dates by position), otherwise in score order.
+    """
+
+    packed, packed_shingles = [], []
+    num_tokens = 0
+    for candidate in candidates:
+        shingles = get_shingles(candidate['text'])
+        if dedup_threshold < 1 and any([len(shingles & s) >= dedup_threshold * len(shingles | s) for s in packed_shingles]):
+            continue
+        candidate_tokens = len(encoding.encode(candidate['text'])) + 1 # separator
+        if num_tokens + candidate_tokens > token_budget:
+            continue
+        packed.append(candidate)
+        packed_shingles.append(shingles)
+        num_tokens += candidate_tokens
+
+    if chronological:
+        packed = sorted(packed, key=lambda c: (parse_date_time(c.get('date_time')) or datetime.min, c.get('position', 0)))
+    return packed
@@ -0,0 +1,276 @@
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import os, re, json
+import struct
+import hashlib
+from collections import OrderedDict
+
+
+# Parsed view of a LoCoMo 'conversation' dict shared by context builders, retrievers and scorers.
+# Sessions are found once, turns are indexed by dia_id, and rendered turn text and token counts
+# are cached on the turns.
+
+SESSION_KEY = re.compile(r'^session_(\d+)$')
+
+MAX_CACHED_CONVERSATIONS = 32
+_CONVERSATIONS = OrderedDict()
+
+# Compiled dataset cache written next to a dataset file as <data_file>.samples:
+#   fixed header: magic, offset and length of the index
+#   one compact JSON blob per sample
+#   JSON index: version, size/mtime/sha1 of the source file and (sample_id, offset, length) per sample
+# The cache is rebuilt when the source changes; a touched but identical source only refreshes the index.
+SAMPLE_CACHE_MAGIC = b'LOCOMOS\x01'
+SAMPLE_CACHE_HEADER = struct.Struct('<8sQQ')
+SAMPLE_CACHE_VERSION = 1
+
+
+class Turn(object):
+
+    __slots__ = ('speaker', 'text', 'dia_id', 'blip_caption', 'img_file', 'session', 'raw', '_rendered', '_token_counts')
+
+    def __init__(self, dialog, session):
+        self.speaker = dialog['speaker']
+        self.text = dialog['text']
+        self.dia_id = dialog.get('dia_id')
+        self.blip_caption = dialog.get('blip_caption')
+        self.img_file = dialog.get('img_file')
+        self.session = session
+        self.raw = dialog
+        self._rendered = None
+        self._token_counts = {}
+
+    def has_image(self):
+        return self.img_file is not None and len(self.img_file) > 0
+
+    def rendered(self):
+        # turn as it appears in full-conversation prompts
+        if self._rendered is None:
+            turn = self.speaker + ' said, \"' + self.text + '\"' + '\n'
+            if self.blip_caption is not None:
+                turn += ' and shared %s.' % self.blip_caption
+            self._rendered = turn + '\n'
+        return self._rendered
+
+    def rag_text(self):
+        # turn as it is stored in the dialog embedding database
+        if self.blip_caption is not None:
+            return self.speaker + ' said, \"' + self.text + '\"' + ' and shared ' + self.blip_caption
+        return self.speaker + ' said, \"' + self.text + '\"'
+
+    def token_count(self, encoding):
+        # tokens of rendered(), cached per tokenizer; the encoding is stored with its count, which
+        # keeps id(encoding) from being reused by another tokenizer while the entry exists
+        cached = self._token_counts.get(id(encoding))
+        if cached is None or cached[0] is not encoding:
+            cached = (encoding, len(encoding.encode(self.rendered())))
+            self._token_counts[id(encoding)] = cached
+        return cached[1]
+
+
+class Session(object):
+
+    __slots__ = ('num', 'date_time', 'turns', 'raw')
+
+    def __init__(self, num, date_time, dialogs):
+        self.num = num
+        self.date_time = date_time
+        self.raw = dialogs
+        self.turns = [Turn(dialog, self) for dialog in dialogs]
+
+
+class Conversation(object):
+
+    __slots__ = ('raw', 'speaker_a', 'speaker_b', 'sessions', 'turns_by_id', 'speaker_names')
+
+    def __init__(self, conversation):
+
+        self.raw = conversation # keeps id(conversation) valid while cached
+        self.speaker_a = conversation.get('speaker_a')
+        self.speaker_b = conversation.get('speaker_b')
+
+        session_nums = sorted([int(SESSION_KEY.match(k).group(1)) for k in conversation.keys() if SESSION_KEY.match(k)])
+        self.sessions = [Session(i, conversation.get('session_%s_date_time' % i), conversation['session_%s' % i]) for i in session_nums]
+        self.turns_by_id = {turn.dia_id: turn for turn in self.turns()}
+
+        # same (set-ordered) speaker pair the prompts have always used
+        first_session = self.sessions[0].turns if len(self.sessions) > 0 else []
+        self.speaker_names = list(set([turn.speaker for turn in first_session]))
+
+    def turns(self):
+        return [turn for session in self.sessions for turn in session.turns]
+
+    def get_turn(self, dia_id):
+        return self.turns_by_id.get(dia_id)
+
+    def get_session(self, num):
+        for session in self.sessions:
+            if session.num == num:
+                return session
+        return None
+
+
+def get_conversation(conversation):
+    """
+    Returns the parsed Conversation of a LoCoMo conversation dict, parsing it at most once while
+    it stays among the most recently used conversations.
+    """
+
+    key = id(conversation)
+    if key in _CONVERSATIONS and _CONVERSATIONS[key].raw is conversation:
+        _CONVERSATIONS.move_to_end(key)
+        return _CONVERSATIONS[key]
+
+    parsed = Conversation(conversation)
+    _CONVERSATIONS[key] = parsed
+    if len(_CONVERSATIONS) > MAX_CACHED_CONVERSATIONS:
+        _CONVERSATIONS.popitem(last=False)
+    return parsed
+
+
+def _file_sha1(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def _source_info(data_file, sha1=None):
+    stat = os.stat(data_file)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha1': sha1}
+
+
+def _write_sample_index(f, index_offset, index):
+    index = json.dumps(index).encode('utf-8')
+    f.seek(index_offset)
+    f.write(index)
+    f.truncate()
+    f.seek(0)
+    f.write(SAMPLE_CACHE_HEADER.pack(SAMPLE_CACHE_MAGIC, index_offset, len(index)))
+
+
+def build_sample_cache(data_file, cache_file):
+
+    raw = open(data_file, 'rb').read()
+    source = _source_info(data_file, hashlib.sha1(raw).hexdigest())
+    samples = json.loads(raw)
+    del raw
+
+    entries = []
+    tmp_file = cache_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(SAMPLE_CACHE_HEADER.pack(SAMPLE_CACHE_MAGIC, 0, 0))
+        offset = SAMPLE_CACHE_HEADER.size
+        for data in samples:
+            blob = json.dumps(data, separators=(',', ':')).encode('utf-8')
+            f.write(blob)
+            entries.append([data['sample_id'], offset, len(blob)])
+            offset += len(blob)
+        _write_sample_index(f, offset, {'version': SAMPLE_CACHE_VERSION, 'source': source, 'samples': entries})
+    os.replace(tmp_file, cache_file)
+
+
+class SampleCache(object):
+    """
+    Read-only view of a compiled dataset cache. Only the index is read when the cache is opened;
+    a sample is deserialized when it is requested, and not kept afterwards.
+    """
+
+    def __init__(self, cache_file):
+
+        self.cache_file = cache_file
+        self.f = open(cache_file, 'rb')
+        magic, self.index_offset, index_length = SAMPLE_CACHE_HEADER.unpack(self.f.read(SAMPLE_CACHE_HEADER.size))
+        assert magic == SAMPLE_CACHE_MAGIC and index_length > 0, "Not a sample cache: %s" % cache_file
+        self.f.seek(self.index_offset)
+        self.index = json.loads(self.f.read(index_length))
+        self.entries = self.index['samples']
+        self.offsets = {sample_id: (offset, length) for sample_id, offset, length in self.entries}
+
+    def is_valid(self, data_file):
+
+        if self.index.get('version') != SAMPLE_CACHE_VERSION:
+            return False
+        source, current = self.index['source'], _source_info(data_file)
+        if source['size'] != current['size']:
+            return False
+        if source['mtime_ns'] == current['mtime_ns']:
+            return True
+        # same size, new mtime: only a changed hash invalidates the cache
+        current['sha1'] = _file_sha1(data_file)
+        if current['sha1'] != source['sha1']:
+            return False
+        self.index['source'] = current
+        try:
+            with open(self.cache_file, 'r+b') as f:
+                _write_sample_index(f, self.index_offset, self.index)
+        except OSError:
+            pass
+        return True
+
+    def _load(self, offset, length):
+        self.f.seek(offset)
+        return json.loads(self.f.read(length))
+
+    def sample_ids(self):
+        return [sample_id for sample_id, _, _ in self.entries]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, sample_id):
+        return sample_id in self.offsets
+
+    def __getitem__(self, i):
+        _, offset, length = self.entries[i]
+        return self._load(offset, length)
+
+    def __iter__(self):
+        for _, offset, length in self.entries:
+            yield self._load(offset, length)
+
+    def get(self, sample_id):
+        if sample_id not in self.offsets:
+            return None
+        return self._load(*self.offsets[sample_id])
+
+
+class SampleList(list):
+    # in-memory fallback with the SampleCache interface
+
+    def sample_ids(self):
+        return [data['sample_id'] for data in self]
+
+    def get(self, sample_id):
+        for data in self:
+            if data['sample_id'] == sample_id:
+                return data
+        return None
+
+
+def load_samples(data_file):
+    """
+    Returns the samples of a dataset file as a lazily loaded SampleCache, compiling
+    <data_file>.samples on first use or when the source changed. Falls back to the parsed
+    samples if the cache cannot be written.
+    """
+
+    cache_file = data_file + '.samples'
+    if os.path.exists(cache_file):
+        try:
+            cache = SampleCache(cache_file)
+            if cache.is_valid(data_file):
+                return cache
+            cache.f.close()
+        except (AssertionError, ValueError, KeyError, struct.error):
+            pass
+
+    try:
+        build_sample_cache(data_file, cache_file)
+    except OSError as e:
+        print("Could not write sample cache %s (%s), loading %s directly" % (cache_file, e, data_file))
+        return SampleList(json.load(open(data_file)))
+    return SampleCache(cache_file)
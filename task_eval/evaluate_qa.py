@@ -3,33 +3,44 @@ from pathlib import Path
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
 import os, json
+import time
 from tqdm import tqdm
 import argparse
-from global_methods import set_openai_key, set_anthropic_key, set_gemini_key
-from task_eval.evaluation import eval_question_answering
-from task_eval.evaluation_stats import analyze_aggr_acc
-from task_eval.gpt_utils import get_gpt_answers
-from task_eval.claude_utils import get_claude_answers
-from task_eval.gemini_utils import get_gemini_answers
-from task_eval.hf_llm_utils import init_hf_model, get_hf_answers
-
 import numpy as np
-import google.generativeai as genai
+from task_eval.backend_utils import BACKENDS, get_backend_name, is_local_backend, load_backend
+from task_eval.data_utils import load_samples
+from task_eval.evaluation_stats import analyze_aggr_acc
+from task_eval.scheduler_utils import RequestScheduler
+from task_eval.journal_utils import PredictionJournal, get_journal_file, get_pending_idxs, resume_out_data
+from llm_cache import print_llm_cache_stats
 
 def parse_args():
 
     parser = argparse.ArgumentParser()
     parser.add_argument('--out-file', required=True, type=str)
     parser.add_argument('--model', required=True, type=str)
+    parser.add_argument('--backend', type=str, default=None, choices=list(BACKENDS.keys()), help="Backend of --model; inferred from the model name if not set (see task_eval/backend_utils.py)")
     parser.add_argument('--data-file', type=str, required=True)
     parser.add_argument('--use-rag', action="store_true")
     parser.add_argument('--use-4bit', action="store_true", default=False)
     parser.add_argument('--batch-size', default=1, type=int)
     parser.add_argument('--rag-mode', type=str, default="")
     parser.add_argument('--emb-dir', type=str, default="")
-    parser.add_argument('--top-k', type=int, default=5)
+    parser.add_argument('--top-k', type=int, nargs='+', default=[5], help="One or more values of k; with several values, retrieval runs once at the largest k and is sliced for the others")
+    parser.add_argument('--context-budget', type=int, default=0, help="Token budget for retrieved context; replaces --top-k: entries of the ranked list up to the largest --top-k are packed in score order until it is full (0 keeps the top-k)")
+    parser.add_argument('--dedup-threshold', type=float, default=0.9, help="Skip retrieved entries whose word-shingle Jaccard similarity with a packed entry reaches this value (with --context-budget)")
+    parser.add_argument('--chronological', action="store_true", help="Order packed context entries by date instead of score (with --context-budget)")
     parser.add_argument('--retriever', type=str, default="contriever")
+    parser.add_argument('--fusion', type=str, default="rrf", choices=["rrf", "weighted"], help="How --retriever hybrid[-<dense>] combines bm25s and dense rankings")
+    parser.add_argument('--hybrid-weight', type=float, default=0.5, help="Weight of the dense retriever in hybrid fusion; bm25s gets 1 - weight")
+    parser.add_argument('--index-dir', type=str, default="", help="Directory to save/load bm25s indexes; indexes are kept in memory only if empty")
     parser.add_argument('--overwrite', action="store_true")
+    parser.add_argument('--bert-score', action="store_true", help="Also store the rescaled BERTScore of every prediction as <model_key>_bert_score (model loaded once, runs on CPU)")
+    parser.add_argument('--rag-full-context', action="store_true", help="HF models: keep the full conversation in RAG prompts instead of only the retrieved turns")
+    parser.add_argument('--prefix-cache', action="store_true", help="HF models: prefill the conversation once per sample and reuse its KV cache for every question")
+    parser.add_argument('--max-concurrency', type=int, default=4, help="Maximum number of API requests in flight")
+    parser.add_argument('--requests-per-minute', type=int, default=None, help="API request budget; defaults to the provider limit of the model, <= 0 for unlimited")
+    parser.add_argument('--tokens-per-minute', type=int, default=0, help="API token budget (prompt + completion); <= 0 for unlimited")
     args = parser.parse_args()
     return args
 
@@ -41,76 +52,95 @@ def main():
 
     print("******************  Evaluating Model %s ***************" % args.model)
 
-    if 'gpt' in args.model:
-        # set openai API key
-        set_openai_key()
+    # only the selected backend (and its SDK or model stack) is imported
+    backend = get_backend_name(args.model, args.backend)
+    get_answers = load_backend(args)
 
-    elif 'claude' in args.model:
-        # set openai API key
-        set_anthropic_key()
-
-    elif 'gemini' in args.model:
-        # set openai API key
-        set_gemini_key()
-        if args.model == "gemini-pro-1.0":
-            model_name = "models/gemini-1.0-pro-latest"
-
-        gemini_model = genai.GenerativeModel(model_name)
-    
-    elif any([model_name in args.model for model_name in ['gemma', 'llama', 'mistral', 'Qwen']]):
-        hf_pipeline, hf_model_name = init_hf_model(args)
-
-    else:
-        raise NotImplementedError
 
+    # top-k sweep: every k is evaluated in this run, retrieval is shared across them
+    top_ks = sorted(set(args.top_k)) if args.use_rag else args.top_k[:1]
+    args.max_top_k = max(top_ks)
 
     # load conversations
-    samples = json.load(open(args.data_file))
-    prediction_key = "%s_prediction" % args.model if not args.use_rag else "%s_%s_top_%s_prediction" % (args.model, args.rag_mode, args.top_k)
-    model_key = "%s" % args.model if not args.use_rag else "%s_%s_top_%s" % (args.model, args.rag_mode, args.top_k)
+    samples = load_samples(args.data_file)
+    model_keys = {k: "%s" % args.model if not args.use_rag else "%s_%s_top_%s" % (args.model, args.rag_mode, k) for k in top_ks}
     # load the output file if it exists to check for overwriting
     if os.path.exists(args.out_file):
         out_samples = {d['sample_id']: d for d in json.load(open(args.out_file))}
     else:
         out_samples = {}
 
+    # predictions finished by an interrupted run are replayed from the journal and skipped
+    if args.overwrite and os.path.exists(get_journal_file(args.out_file)):
+        os.remove(get_journal_file(args.out_file))
+    journal = PredictionJournal(get_journal_file(args.out_file))
+
 
+    # API requests of all samples and values of k are collected first and run concurrently
+    requests = []
     for data in samples:
 
-        out_data = {'sample_id': data['sample_id']}
-        if data['sample_id'] in out_samples:
-            out_data['qa'] = out_samples[data['sample_id']]['qa'].copy()
-        else:
-            out_data['qa'] = data['qa'].copy()
-
-        if 'gpt' in args.model:
-            # get answers for each sample
-            answers = get_gpt_answers(data, out_data, prediction_key, args)
-        elif 'claude' in args.model:
-            answers = get_claude_answers(data, out_data, prediction_key, args)
-        elif 'gemini' in args.model:
-            answers = get_gemini_answers(gemini_model, data, out_data, prediction_key, args)
-        elif any([model_name in args.model for model_name in ['gemma', 'llama', 'mistral', 'Qwen']]):
-            answers = get_hf_answers(data, out_data, args, hf_pipeline, hf_model_name)
-        else:
-            raise NotImplementedError
-
-        # evaluate individual QA samples and save the score
-        exact_matches, lengths, recall = eval_question_answering(answers['qa'], prediction_key)
-        for i in range(0, len(answers['qa'])):
-            answers['qa'][i][model_key + '_f1'] = round(exact_matches[i], 3)
-            if args.use_rag and len(recall) > 0:
-                answers['qa'][i][model_key + '_recall'] = round(recall[i], 3)
-
-        out_samples[data['sample_id']] = answers
-
-
-    with open(args.out_file, 'w') as f:
+        out_data = resume_out_data(data, out_samples, journal)
+
+        for top_k in top_ks:
+
+            args.top_k = top_k
+            prediction_key = model_keys[top_k] + '_prediction'
+
+            if is_local_backend(backend):
+                # local generation is synchronous and batched, so it is journaled per sample and k
+                pending = get_pending_idxs(out_data, prediction_key, args.overwrite)
+                start = time.time()
+                out_data = get_answers(data, out_data, prediction_key, args)
+                journal.log_predictions(out_data, prediction_key, pending, (time.time() - start) / max(len(pending), 1))
+            else:
+                requests.extend(get_answers(data, out_data, prediction_key, args))
+
+        out_samples[data['sample_id']] = out_data
+
+
+    if args.requests_per_minute is None:
+        # replaces the fixed sleeps between calls to rate-limited models
+        args.requests_per_minute = 12 if 'gpt-4' in args.model else 2 if args.model == 'gemini-pro-1.0' else 0
+    scheduler = RequestScheduler(args.max_concurrency, args.requests_per_minute, args.tokens_per_minute)
+    scheduler.run(requests, on_done=journal.log_request)
+    journal.sync()
+    print_llm_cache_stats()
+
+
+    # evaluate individual QA samples and save the score; the scoring module (nltk, regex) is
+    # imported only here so that startup stays fast
+    from task_eval.evaluation import eval_question_answering, eval_rouge, ROUGE_METRICS
+    rouge = {model_key: {metric: [] for metric in ROUGE_METRICS} for model_key in model_keys.values()}
+    for sample_id in samples.sample_ids():
+        out_data = out_samples[sample_id]
+        for model_key in model_keys.values():
+            exact_matches, lengths, recall = eval_question_answering(out_data['qa'], model_key + '_prediction')
+            for i in range(0, len(out_data['qa'])):
+                out_data['qa'][i][model_key + '_f1'] = round(exact_matches[i], 3)
+                if args.use_rag and len(recall) > 0:
+                    out_data['qa'][i][model_key + '_recall'] = round(recall[i], 3)
+            for metric, scores in eval_rouge(out_data['qa'], model_key + '_prediction').items():
+                rouge[model_key][metric].extend(scores)
+            if args.bert_score:
+                bert_scores = eval_question_answering(out_data['qa'], model_key + '_prediction', metric='bert_score')[0]
+                for i in range(0, len(out_data['qa'])):
+                    out_data['qa'][i][model_key + '_bert_score'] = round(bert_scores[i], 3)
+
+
+    # the journal is compacted into the output file, which replaces the old one atomically
+    for model_key, scores in rouge.items():
+        print("%s: %s" % (model_key, ', '.join(["%s %.3f" % (metric, np.mean(scores[metric])) for metric in ROUGE_METRICS])))
+
+    with open(args.out_file + '.tmp', 'w') as f:
         json.dump(list(out_samples.values()), f, indent=2)
+    os.replace(args.out_file + '.tmp', args.out_file)
+    journal.remove()
 
     
-    analyze_aggr_acc(args.data_file, args.out_file, args.out_file.replace('.json', '_stats.json'),
-                model_key, model_key + '_f1', rag=args.use_rag)
+    for model_key in model_keys.values():
+        analyze_aggr_acc(args.data_file, args.out_file, args.out_file.replace('.json', '_stats.json'),
+                    model_key, model_key + '_f1', rag=args.use_rag)
     # encoder=tiktoken.encoding_for_model(args.model))
 
 
@@ -0,0 +1,175 @@
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import os, json
+import time
+import argparse
+import numpy as np
+from task_eval.data_utils import get_conversation, load_samples
+from task_eval.evaluation import get_evidence_recall
+from task_eval.rag_utils import get_embeddings, get_bm25s_text_index, bm25s_score_matrix, fuse_scores, \
+    is_hybrid_retriever, get_top_k_indices, get_bm25s_turn_text, get_bm25s_entry_text, get_database_bm25s_texts
+
+
+# Retrieval-only benchmark: no LLM calls. Every retriever ranks the entries of each rag mode for
+# every question that has evidence; recall@k uses the same rule as eval_question_answering.
+#
+# Retriever names: dense encoders (contriever, dragon, dpr, openai), bm25s[-<method>][-stem]
+# (e.g. bm25s, bm25s-robertson, bm25s-stem) and hybrid[-<dense encoder>]. bm25s indexes the same
+# entry texts as the bm25s retriever of evaluate_qa.py, hybrid the same as its hybrid retriever.
+
+
+def parse_args():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-file', type=str, required=True)
+    parser.add_argument('--out-file', type=str, default="", help="Optional json file for the results table")
+    parser.add_argument('--retrievers', type=str, nargs='+', default=['bm25s', 'bm25s-stem', 'contriever', 'dragon', 'dpr', 'hybrid'])
+    parser.add_argument('--rag-modes', type=str, nargs='+', default=['dialog', 'observation', 'summary'])
+    parser.add_argument('--top-k', type=int, nargs='+', default=[1, 5, 10, 25, 50])
+    parser.add_argument('--fusion', type=str, default="rrf", choices=["rrf", "weighted"])
+    parser.add_argument('--hybrid-weight', type=float, default=0.5)
+    args = parser.parse_args()
+    return args
+
+
+def get_retrieval_corpus(data, rag_mode):
+
+    # same entries as the embedding databases of prepare_for_rag, get_facts.py and get_session_summaries.py,
+    # read from the observations and summaries released with the dataset; bm25_texts are the texts
+    # the bm25s retriever of the QA path indexes for them
+    texts, date_times, context_ids, bm25_texts = [], [], [], []
+    for session in get_conversation(data['conversation']).sessions:
+        i, date_time = session.num, session.date_time
+        if rag_mode == 'dialog':
+            for turn in session.turns:
+                texts.append(turn.rag_text())
+                date_times.append(date_time)
+                context_ids.append(turn.dia_id)
+                bm25_texts.append(get_bm25s_turn_text(turn.raw, date_time or ''))
+        elif rag_mode == 'observation':
+            for speaker, facts in data.get('observation', {}).get('session_%s_observation' % i, {}).items():
+                for fact, dia_id in facts:
+                    texts.append(fact)
+                    date_times.append(date_time)
+                    context_ids.append(dia_id)
+                    bm25_texts.append(get_bm25s_entry_text(fact, date_time or ''))
+        elif rag_mode == 'summary':
+            if 'session_%s_summary' % i in data.get('session_summary', {}):
+                texts.append(data['session_summary']['session_%s_summary' % i])
+                date_times.append(date_time)
+                context_ids.append('S%s' % i)
+                bm25_texts.append(get_bm25s_entry_text(texts[-1], date_time or ''))
+        else:
+            raise ValueError
+    return texts, date_times, context_ids, bm25_texts
+
+
+def get_entry_ids(context_id):
+    if type(context_id) == str:
+        return [s.strip() for s in context_id.split(',')]
+    return list(context_id)
+
+
+def parse_bm25s_retriever(retriever):
+    # bm25s[-<method>][-stem]
+    options = retriever.split('-')[1:]
+    methods = [o for o in options if o != 'stem']
+    return (methods[0] if methods else 'lucene'), 'stem' in options
+
+
+def build_corpus_index(retriever, texts, date_times, bm25_texts):
+
+    # bm25s index or corpus embeddings (plus the bm25s index for hybrid) of one conversation
+    if retriever.lower().startswith('bm25'):
+        method, use_stemmer = parse_bm25s_retriever(retriever)
+        return get_bm25s_text_index(bm25_texts, method=method, use_stemmer=use_stemmer), None
+    context_embeddings = np.asarray(get_embeddings(retriever, texts, 'context'))
+    if is_hybrid_retriever(retriever):
+        return context_embeddings, get_bm25s_text_index(get_database_bm25s_texts(date_times, texts))
+    return context_embeddings, None
+
+
+def get_score_matrix(retriever, questions, corpus_index, num_docs, args):
+
+    if retriever.lower().startswith('bm25'):
+        _, use_stemmer = parse_bm25s_retriever(retriever)
+        return bm25s_score_matrix(corpus_index[0], questions, num_docs, use_stemmer=use_stemmer)
+
+    context_embeddings, bm25_index = corpus_index
+    query_embeddings = get_embeddings(retriever, questions, 'query')
+    scores = np.dot(np.atleast_2d(query_embeddings), context_embeddings.T)
+    if bm25_index is not None:
+        bm25_scores = bm25s_score_matrix(bm25_index, questions, num_docs)
+        scores = fuse_scores([scores, bm25_scores], args.fusion, [args.hybrid_weight, 1 - args.hybrid_weight])
+    return scores
+
+
+def evaluate_retriever(samples, retriever, rag_mode, top_ks, args):
+
+    max_top_k = max(top_ks)
+    recalls = {k: [] for k in top_ks}
+    reciprocal_ranks = []
+    num_queries = 0
+    elapsed = 0.0
+    build_elapsed = 0.0
+    for data in samples:
+
+        qas = [qa for qa in data['qa'] if len(qa.get('evidence', [])) > 0]
+        texts, date_times, context_ids, bm25_texts = get_retrieval_corpus(data, rag_mode)
+        if len(qas) == 0 or len(texts) == 0:
+            continue
+
+        # corpus indexing (bm25s index build or corpus embeddings) is timed separately from the
+        # queries, which cover query encoding, scoring and top-k selection
+        start = time.time()
+        corpus_index = build_corpus_index(retriever, texts, date_times, bm25_texts)
+        build_elapsed += time.time() - start
+        start = time.time()
+        scores = get_score_matrix(retriever, [qa['question'] for qa in qas], corpus_index, len(texts), args)
+        top_idxs = get_top_k_indices(scores, max_top_k)
+        elapsed += time.time() - start
+        num_queries += len(qas)
+
+        for qa, idxs in zip(qas, top_idxs):
+            ranked_ids = [get_entry_ids(context_ids[idx]) for idx in idxs]
+            for k in top_ks:
+                recalls[k].append(get_evidence_recall([c for ids in ranked_ids[:k] for c in ids], qa['evidence']))
+            first_hit = [rank for rank, ids in enumerate(ranked_ids) if get_evidence_recall(ids, qa['evidence']) > 0]
+            reciprocal_ranks.append(1.0 / (first_hit[0] + 1) if len(first_hit) > 0 else 0.0)
+
+    if num_queries == 0:
+        return []
+    return [{'retriever': retriever, 'rag_mode': rag_mode, 'k': k,
+             'recall': round(float(np.mean(recalls[k])), 4),
+             'mrr': round(float(np.mean(reciprocal_ranks)), 4),
+             'queries_per_sec': round(num_queries / max(elapsed, 1e-9), 1),
+             'corpus_build_sec': round(build_elapsed, 3),
+             'num_queries': num_queries} for k in top_ks]
+
+
+def main():
+
+    args = parse_args()
+    samples = load_samples(args.data_file)
+    top_ks = sorted(set(args.top_k))
+
+    results = []
+    print("%-16s %-12s %5s %8s %8s %10s %10s" % ('retriever', 'rag_mode', 'k', 'recall', 'mrr@%s' % max(top_ks), 'queries/s', 'build (s)'))
+    for retriever in args.retrievers:
+        for rag_mode in args.rag_modes:
+            rows = evaluate_retriever(samples, retriever, rag_mode, top_ks, args)
+            if len(rows) == 0:
+                print("No %s entries in %s, skipping" % (rag_mode, args.data_file))
+            for row in rows:
+                print("%-16s %-12s %5s %8.4f %8.4f %10.1f %10.3f" % (row['retriever'], row['rag_mode'], row['k'], row['recall'], row['mrr'], row['queries_per_sec'], row['corpus_build_sec']))
+            results.extend(rows)
+
+    if args.out_file:
+        with open(args.out_file, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
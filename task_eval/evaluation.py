@@ -4,14 +4,23 @@ import string
 import unicodedata
 from typing import List
 import numpy as np
-from collections import Counter
+from collections import Counter, defaultdict, deque
+from functools import lru_cache
+import itertools
+from multiprocessing import Pool
 import os
-from bert_score import score
 from nltk.stem import PorterStemmer
 ps = PorterStemmer()
 
 LENGTH_THRESHOLD = 5
 
+# answer normalization is compiled once; normalized and stemmed tokens are cached per distinct
+# string, since the same answers and predictions are scored again for every model key and top-k
+ARTICLES = regex.compile(r'\b(a|an|the|and)\b')
+REMOVE_PUNCTUATION = str.maketrans('', '', string.punctuation)
+STEM_CACHE_SIZE = 1 << 16
+ANSWER_CACHE_SIZE = 1 << 18
+
 class SimpleTokenizer(object):
     ALPHA_NUM = r'[\p{L}\p{N}\p{M}]+'
     NON_WS = r'[^\p{Z}\p{C}]'
@@ -56,40 +65,112 @@ def check_answer(example, tokenizer) -> List[bool]:
 
 def has_answer(answers, text, tokenizer=SimpleTokenizer()) -> bool:
     """Check if a document contains an answer string."""
-    text = _normalize(text)
-    text = tokenizer.tokenize(text, uncased=True)
-
-    for answer in answers:
-        answer = _normalize(answer)
-        answer = tokenizer.tokenize(answer, uncased=True)
-        for i in range(0, len(text) - len(answer) + 1):
-            if answer == text[i: i + len(answer)]:
-                return True
-    return False
+    return get_answer_matcher(tuple(answers), tokenizer).contains(get_text_ids(text, tokenizer))
 
 
 def _normalize(text):
     return unicodedata.normalize('NFD', text)
 
 
+# token strings are interned to ints once per process; see get_text_ids and get_answer_ids
+_TOKEN_IDS = {}
+TEXT_CACHE_SIZE = 1024
+MATCHER_CACHE_SIZE = 4096
+
+
+def intern_tokens(tokens):
+    return tuple([_TOKEN_IDS.setdefault(token, len(_TOKEN_IDS)) for token in tokens])
+
+
+@lru_cache(maxsize=TEXT_CACHE_SIZE)
+def get_text_ids(text, tokenizer):
+    # uncased tokens of a document as ids; retrieved documents repeat across questions
+    return intern_tokens(tokenizer.tokenize(_normalize(text), uncased=True))
+
+
+class AnswerMatcher(object):
+    """
+    Aho-Corasick automaton over the token id sequences of a set of answers: one pass over a
+    document finds every answer it contains.
+    """
+
+    def __init__(self, answers, tokenizer):
+
+        self.patterns = [intern_tokens(tokenizer.tokenize(_normalize(answer), uncased=True)) for answer in answers]
+        # an answer without tokens is contained in every document
+        self.matches_empty = any([len(pattern) == 0 for pattern in self.patterns])
+
+        # trie: goto[node] maps a token id to the next node, out[node] holds the answers ending there
+        self.goto = [{}]
+        self.out = [set()]
+        for k, pattern in enumerate(self.patterns):
+            node = 0
+            for token in pattern:
+                if token not in self.goto[node]:
+                    self.goto.append({})
+                    self.out.append(set())
+                    self.goto[node][token] = len(self.goto) - 1
+                node = self.goto[node][token]
+            self.out[node].add(k)
+
+        # failure links in breadth-first order; outputs of the failure node are inherited
+        self.fail = [0] * len(self.goto)
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for token, child in self.goto[node].items():
+                queue.append(child)
+                state = self.fail[node]
+                while state and token not in self.goto[state]:
+                    state = self.fail[state]
+                self.fail[child] = self.goto[state].get(token, 0)
+                self.out[child] |= self.out[self.fail[child]]
+
+    def _scan(self, ids):
+        node = 0
+        for token in ids:
+            while node and token not in self.goto[node]:
+                node = self.fail[node]
+            node = self.goto[node].get(token, 0)
+            if self.out[node]:
+                yield self.out[node]
+
+    def contains(self, ids):
+        if self.matches_empty:
+            return True
+        for _ in self._scan(ids):
+            return True
+        return False
+
+    def find(self, ids):
+        # indices of all answers contained in the document
+        found = set([k for k, pattern in enumerate(self.patterns) if len(pattern) == 0])
+        for matched in self._scan(ids):
+            found |= matched
+        return found
+
+
+@lru_cache(maxsize=MATCHER_CACHE_SIZE)
+def get_answer_matcher(answers, tokenizer):
+    return AnswerMatcher(answers, tokenizer)
+
+
+@lru_cache(maxsize=ANSWER_CACHE_SIZE)
 def normalize_answer(s):
+    # lower case, drop punctuation and articles, collapse white space
+    s = s.replace(',', "").lower().translate(REMOVE_PUNCTUATION)
+    return ' '.join(ARTICLES.sub(' ', s).split())
 
-    s = s.replace(',', "")
-    def remove_articles(text):
-        # return regex.sub(r'\b(a|an|the)\b', ' ', text)
-        return regex.sub(r'\b(a|an|the|and)\b', ' ', text)
 
-    def white_space_fix(text):
-        return ' '.join(text.split())
+@lru_cache(maxsize=STEM_CACHE_SIZE)
+def stem(word):
+    return ps.stem(word)
 
-    def remove_punc(text):
-        exclude = set(string.punctuation)
-        return ''.join(ch for ch in text if ch not in exclude)
 
-    def lower(text):
-        return text.lower()
-
-    return white_space_fix(remove_articles(remove_punc(lower(s))))
+@lru_cache(maxsize=ANSWER_CACHE_SIZE)
+def get_answer_tokens(s):
+    # stemmed tokens of the normalized answer and their counts
+    tokens = tuple([stem(w) for w in normalize_answer(s).split()])
+    return tokens, Counter(tokens)
 
 
 def exact_match_score(prediction, ground_truth):
@@ -111,12 +192,109 @@ def exact_match_score(prediction, ground_truth):
 #     return max(0, max(values))
 
 
+class BertScorer(object):
+    """
+    Rescaled BERTScore F1 of many (prediction, reference) pairs at once, with the same numbers as
+    bert_score.score(..., lang='en', rescale_with_baseline=True). The model, tokenizer and baseline
+    are loaded once. Sentences are embedded in length-sorted batches, and reference embeddings are
+    kept across calls so that comparing several models on the same answers embeds them once.
+    """
+
+    def __init__(self, lang='en', device='cpu', batch_size=64):
+
+        # bert_score loads torch and transformers, only import it when it is used
+        import torch
+        import pandas as pd
+        import bert_score as bert_score_package
+        from bert_score.utils import lang2model, model2layers, get_model, get_tokenizer
+
+        self.device = device
+        self.batch_size = batch_size
+        self.model_type = lang2model[lang]
+        self.num_layers = model2layers[self.model_type]
+        self.tokenizer = get_tokenizer(self.model_type)
+        self.model = get_model(self.model_type, self.num_layers).to(device)
+
+        # no idf weighting, special tokens are ignored
+        self.idf_dict = defaultdict(lambda: 1.0)
+        self.idf_dict[self.tokenizer.sep_token_id] = 0
+        self.idf_dict[self.tokenizer.cls_token_id] = 0
+
+        baseline_file = os.path.join(os.path.dirname(bert_score_package.__file__), 'rescale_baseline', lang, self.model_type + '.tsv')
+        self.baseline = torch.from_numpy(pd.read_csv(baseline_file).iloc[self.num_layers].to_numpy())[1:].float()
+
+        self.reference_embeddings = {}
+
+    def embed(self, sentences, cache):
+
+        from bert_score.utils import get_bert_embedding
+
+        # longest first, so that each batch is padded to similar lengths
+        sentences = sorted(set([s for s in sentences if s not in cache]), key=lambda s: len(s.split(' ')), reverse=True)
+        for start in range(0, len(sentences), self.batch_size):
+            batch = sentences[start:start + self.batch_size]
+            embeddings, masks, padded_idf = get_bert_embedding(batch, self.model, self.tokenizer, self.idf_dict, device=self.device)
+            embeddings, masks, padded_idf = embeddings.cpu(), masks.cpu(), padded_idf.cpu()
+            for i, sentence in enumerate(batch):
+                length = masks[i].sum().item()
+                cache[sentence] = (embeddings[i, :length], padded_idf[i, :length])
+
+    def pad(self, sentences, cache):
+
+        import torch
+        from torch.nn.utils.rnn import pad_sequence
+
+        embeddings, idfs = zip(*[cache[s] for s in sentences])
+        lengths = torch.tensor([e.size(0) for e in embeddings], dtype=torch.long)
+        mask = torch.arange(lengths.max()).expand(len(lengths), lengths.max()) < lengths.unsqueeze(1)
+        return (pad_sequence([e.to(self.device) for e in embeddings], batch_first=True, padding_value=2.0),
+                mask.to(self.device),
+                pad_sequence([i.to(self.device) for i in idfs], batch_first=True))
+
+    def score(self, predictions, references):
+        """
+        Returns the rescaled F1 of every pair as a list of floats.
+        """
+
+        import torch
+        from bert_score.utils import greedy_cos_idf
+
+        if len(predictions) == 0:
+            return []
+        prediction_embeddings = {}
+        self.embed(references, self.reference_embeddings)
+        self.embed(predictions, prediction_embeddings)
+
+        f1s = []
+        with torch.no_grad():
+            for start in range(0, len(predictions), self.batch_size):
+                P, R, F1 = greedy_cos_idf(*self.pad(references[start:start + self.batch_size], self.reference_embeddings),
+                                          *self.pad(predictions[start:start + self.batch_size], prediction_embeddings))
+                f1s.append(F1.cpu())
+        f1s = torch.cat(f1s, dim=0)
+        f1s = (f1s - self.baseline[2]) / (1 - self.baseline[2])
+        return f1s.tolist()
+
+
+_BERT_SCORER = None
+
+
+def get_bert_scorer():
+    global _BERT_SCORER
+    if _BERT_SCORER is None:
+        _BERT_SCORER = BertScorer()
+    return _BERT_SCORER
+
+
+def bert_scores(predictions, ground_truths):
+    # batched bert_score()
+    predictions = [normalize_answer(p) for p in predictions]
+    ground_truths = [normalize_answer(g) for g in ground_truths]
+    return [max(0, f1) for f1 in get_bert_scorer().score(predictions, ground_truths)]
+
+
 def bert_score(prediction, ground_truth):
-    prediction = normalize_answer(prediction)
-    ground_truth = normalize_answer(ground_truth)
-    P, R, F1 = score([prediction], [ground_truth], lang='en', verbose=False, rescale_with_baseline=True)
-    # print('# BERT # ', normalize_answer(prediction), ' | ', normalize_answer(ground_truth), ' #', P, R, F1)
-    return max(0, F1[0].item())
+    return bert_scores([prediction], [ground_truth])[0]
 
 
 def ems(prediction, ground_truths):
@@ -124,9 +302,9 @@ def ems(prediction, ground_truths):
 
 
 def f1_score(prediction, ground_truth):
-    prediction_tokens = [ps.stem(w) for w in normalize_answer(prediction).split()]
-    ground_truth_tokens = [ps.stem(w) for w in normalize_answer(ground_truth).split()]
-    common = Counter(prediction_tokens) & Counter(ground_truth_tokens)
+    prediction_tokens, prediction_counts = get_answer_tokens(prediction)
+    ground_truth_tokens, ground_truth_counts = get_answer_tokens(ground_truth)
+    common = prediction_counts & ground_truth_counts
     num_same = sum(common.values())
     if num_same == 0:
         return 0
@@ -145,15 +323,77 @@ def f1(prediction, ground_truth):
     return np.mean([max([f1_score(prediction, gt) for prediction in predictions]) for gt in ground_truths])
 
 
+# ROUGE-1/2/L with the same numbers as rouge.Rouge().get_scores on the normalized, stemmed
+# answers. Normalized answers have no '.', so each one is a single sentence; n-grams are counted
+# as sets (the package's exclusive mode) and ROUGE-L counts the distinct tokens of one LCS,
+# backtracked the way the package does.
+ROUGE_METRICS = ['rouge-1', 'rouge-2', 'rouge-l']
+
+
+@lru_cache(maxsize=ANSWER_CACHE_SIZE)
+def get_answer_ids(s):
+    # stemmed tokens of the normalized answer as integer ids
+    return intern_tokens(get_answer_tokens(s)[0])
+
+
+def _rouge_f_p_r(overlap, hyp_count, ref_count):
+    precision = overlap / hyp_count if hyp_count > 0 else 0.0
+    recall = overlap / ref_count if ref_count > 0 else 0.0
+    return {'f': 2.0 * ((precision * recall) / (precision + recall + 1e-8)), 'p': precision, 'r': recall}
+
+
+def lcs_tokens(x, y):
+    # tokens of x on a longest common subsequence of x and y
+    n, m = len(x), len(y)
+    table = [[0] * (m + 1) for _ in range(n + 1)]
+    for i in range(1, n + 1):
+        xi, row, prev = x[i - 1], table[i], table[i - 1]
+        for j in range(1, m + 1):
+            row[j] = prev[j - 1] + 1 if xi == y[j - 1] else max(prev[j], row[j - 1])
+    tokens = []
+    i, j = n, m
+    while i > 0 and j > 0:
+        if x[i - 1] == y[j - 1]:
+            tokens.append(x[i - 1])
+            i, j = i - 1, j - 1
+        elif table[i - 1][j] > table[i][j - 1]:
+            i -= 1
+        else:
+            j -= 1
+    return tokens
+
+
+def rouge_scores(prediction_ids, reference_ids):
+    """
+    ROUGE-1, ROUGE-2 and ROUGE-L {'f', 'p', 'r'} of two token id sequences, or None if either is
+    empty (the package raises ValueError).
+    """
+    if len(prediction_ids) == 0 or len(reference_ids) == 0:
+        return None
+    scores = {}
+    for n, metric in [(1, 'rouge-1'), (2, 'rouge-2')]:
+        hyp_ngrams = set(zip(*[prediction_ids[k:] for k in range(n)]))
+        ref_ngrams = set(zip(*[reference_ids[k:] for k in range(n)]))
+        scores[metric] = _rouge_f_p_r(len(hyp_ngrams & ref_ngrams), len(hyp_ngrams), len(ref_ngrams))
+    lcs = len(set(lcs_tokens(reference_ids, prediction_ids)))
+    scores['rouge-l'] = _rouge_f_p_r(lcs, len(set(prediction_ids)), len(set(reference_ids)))
+    return scores
+
+
+def rouge_batch(predictions, references):
+    # f scores of every (prediction, reference) pair: {metric: [f, ...]}
+    results = {metric: [] for metric in ROUGE_METRICS}
+    for prediction, reference in zip(predictions, references):
+        scores = rouge_scores(get_answer_ids(prediction), get_answer_ids(reference))
+        for metric in ROUGE_METRICS:
+            results[metric].append(0.0 if scores is None else scores[metric]['f'])
+    return results
+
+
 def rougel_score(prediction, ground_truth):
-    from rouge import Rouge
-    rouge = Rouge()
-    prediction = ' '.join([ps.stem(w) for w in normalize_answer(prediction).split()])
-    ground_truth = ' '.join([ps.stem(w) for w in normalize_answer(ground_truth).split()])
-    # no normalization
-    try:
-        scores = rouge.get_scores(prediction, ground_truth, avg=True)
-    except ValueError:  # "Hypothesis is empty."
+    # reports ROUGE-1 F, as it always has
+    scores = rouge_scores(get_answer_ids(prediction), get_answer_ids(ground_truth))
+    if scores is None:  # "Hypothesis is empty."
         return 0.0
     return scores["rouge-1"]["f"]
 
@@ -163,33 +403,115 @@ def rl(prediction, ground_truths):
 
 
 ## file-level evaluation ... ### 
-def eval_recall(infile):
+EVAL_CHUNK_LINES = 1000
+
+
+def read_line_chunks(infile, chunk_size=EVAL_CHUNK_LINES):
+    # streams the result lines of a file in chunks, skipping the header line
+    with open(infile, 'r') as f:
+        next(f, None)
+        chunk = []
+        for line in f:
+            chunk.append(line)
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def run_chunked(infile, score_chunk, num_workers=None):
+    """
+    Scores the lines of infile chunk by chunk with score_chunk(lines) -> (Counter of partial sums,
+    Counter of (category, output length) pairs), in a process pool when there is more than one
+    chunk, and returns both Counters merged over the file.
+    At most two chunks per worker are in flight, so memory does not grow with the file.
+    """
+
+    num_workers = num_workers or os.cpu_count() or 1
+    chunks = read_line_chunks(infile)
+    first = next(chunks, None)
+    second = next(chunks, None)
+    totals, lengths = Counter(), Counter()
+    if first is None:
+        return totals, lengths
+
+    def merge(result):
+        totals.update(result[0])
+        lengths.update(result[1])
+
+    chunks = itertools.chain([first] if second is None else [first, second], chunks)
+    if second is None or num_workers == 1:
+        for chunk in chunks:
+            merge(score_chunk(chunk))
+        return totals, lengths
+
+    pending = deque()
+    with Pool(num_workers) as pool:
+        for chunk in chunks:
+            pending.append(pool.apply_async(score_chunk, (chunk,)))
+            if len(pending) >= 2 * num_workers:
+                merge(pending.popleft().get())
+        while pending:
+            merge(pending.popleft().get())
+    return totals, lengths
+
+
+def get_length_histograms(lengths):
+    # {category: {output length: count}} from the merged (category, length) Counter of run_chunked
+    histograms = defaultdict(Counter)
+    for (category, length), count in lengths.items():
+        histograms[category][length] = count
+    return dict(histograms)
+
+
+def _get_answer(line):
+    return line['answer'] if line.get('answer') is not None else line['adversarial_answer']
+
+
+def _score_recall_chunk(lines):
 
     tokenizer = SimpleTokenizer()
-    lines = open(infile, 'r').readlines()[1:]
-
-    has_answer_count = 0
-    answer_lengths = []
+    totals, lengths = Counter(), Counter()
     for line in lines:
         line = json.loads(line)
-        answer = line['answer'] if line.get('answer') is not None else line('adversarial_answer')
         output = ' || '.join(line['output'])
+        totals['count'] += 1
+        totals['has_answer'] += int(has_answer(_get_answer(line), output, tokenizer))
+        totals['length'] += len(output.split())
+        lengths[(line.get('category'), len(output.split()))] += 1
+    return totals, lengths
 
-        if has_answer(answer, output, tokenizer):
-            has_answer_count += 1
 
-        answer_lengths.append(len(output.split()))
+def eval_recall(infile, num_workers=None, return_histograms=False):
 
-    recall = round(has_answer_count/len(lines), 4)
-    lens = round(np.mean(answer_lengths), 4)
+    totals, lengths = run_chunked(infile, _score_recall_chunk, num_workers)
+    recall = round(totals['has_answer']/totals['count'], 4)
+    lens = round(totals['length']/totals['count'], 4)
 
+    if return_histograms:
+        return recall, lens, get_length_histograms(lengths)
     return recall, lens
 
 
-def eval_question_answering(qas, eval_key='prediction', metric='f1'):
+def get_evidence_recall(context_ids, evidence):
+
+    # recall_acc for dialog
+    if len(context_ids) > 0 and context_ids[0].startswith('S'):
+        # session ids (summaries) cover every dialog turn of that session
+        sessions = [e[1:] for e in context_ids]
+        return float(sum([ev.split(':')[0][1:] in sessions for ev in evidence]))/len(evidence)
+    else:
+        return float(sum([ev in context_ids for ev in evidence]))/len(evidence)
 
 
+def eval_question_answering(qas, eval_key='prediction', metric='f1'):
+
+    # metric: 'f1' (token F1, partial F1 over sub-answers for multi-hop) or 'bert_score'
+    # (rescaled BERTScore F1 of the whole answer, computed in one batch for all questions)
+    assert metric in ['f1', 'bert_score'], metric
     all_ems = []
+    bert_pairs = []
     all_recall = []
     exact_match_count = 0
     f1_count = 0
@@ -212,8 +534,12 @@ def eval_question_answering(qas, eval_key='prediction', metric='f1'):
         
         output = line[eval_key]
         
+        if metric == 'bert_score' and line['category'] in [1, 2, 3, 4]:
+            bert_pairs.append((i, output, answer))
+            all_ems.append(None)
+
         # single-hop, temporal, open-domain eval without splitting for sub-answers 
-        if line['category'] in [2, 3, 4]:
+        elif line['category'] in [2, 3, 4]:
             all_ems.append(f1_score(output, answer))
         
         # multi-hop eval by splitting entire phrase into sub-answers and computing partial F1 for each
@@ -233,31 +559,40 @@ def eval_question_answering(qas, eval_key='prediction', metric='f1'):
         assert i+1 == len(all_ems), all_ems
 
         if eval_key + '_context' in line and len(line['evidence']) > 0:
-            # recall_acc for dialog
-            if line[eval_key + '_context'][0].startswith('S'):
-                sessions = [e[1:] for e in line[eval_key + '_context']]
-                recall_acc = float(sum([ev.split(':')[0][1:] in sessions for ev in line["evidence"]]))/len(line['evidence'])
-            else:
-                recall_acc = float(sum([ev in line[eval_key + '_context'] for ev in line["evidence"]]))/len(line['evidence'])
-            all_recall.append(recall_acc)
+            all_recall.append(get_evidence_recall(line[eval_key + '_context'], line['evidence']))
         else:
             all_recall.append(1)
 
+    if len(bert_pairs) > 0:
+        idxs, outputs, answers = zip(*bert_pairs)
+        for i, score in zip(idxs, bert_scores(list(outputs), list(answers))):
+            all_ems[i] = score
+
     print("{} QA samples evaluated; {} accuracy values".format(len(qas), len(all_ems)))
     lens = 0.0
     return all_ems, lens, all_recall
 
 
-def eval_fact_checking(infile):
+def eval_rouge(qas, eval_key='prediction'):
 
-    tokenizer = SimpleTokenizer()
-    lines = open(infile, 'r').readlines()[1:]
+    # ROUGE-1/2/L F of every QA against the same reference answer used for F1
+    predictions, references = [], []
+    for line in qas:
+        answer = str(line['answer']) if line.get('answer') is not None else str(line['adversarial_answer'])
+        if line['category'] == 3:
+            answer = answer.split(';')[0].strip()
+        predictions.append(str(line.get(eval_key, '')))
+        references.append(answer)
+    return rouge_batch(predictions, references)
 
-    exact_match_count = 0
-    answer_lengths = []
+
+def _score_fact_checking_chunk(lines):
+
+    tokenizer = SimpleTokenizer()
+    totals, lengths = Counter(), Counter()
     for line in lines:
         line = json.loads(line)
-        answer = line['answer'] if line.get('answer') is not None else line('adversarial_answer')
+        answer = _get_answer(line)
         output = line['output'][0]
 
         if answer == ["refutes"]:
@@ -265,36 +600,47 @@ def eval_fact_checking(infile):
         if answer == ["supports"]:
             answer = ["supports", "yes", "true"]
 
-        if has_answer(answer, output, tokenizer):
-            exact_match_count += 1
-        
-        answer_lengths.append(len(output.split()))
+        totals['count'] += 1
+        totals['exact_match'] += int(has_answer(answer, output, tokenizer))
+        totals['length'] += len(output.split())
+        lengths[(line.get('category'), len(output.split()))] += 1
+    return totals, lengths
 
-    em = round(exact_match_count/len(lines), 4)
-    lens = round(np.mean(answer_lengths), 4)
 
-    return em, lens
+def eval_fact_checking(infile, num_workers=None, return_histograms=False):
+
+    totals, lengths = run_chunked(infile, _score_fact_checking_chunk, num_workers)
+    em = round(totals['exact_match']/totals['count'], 4)
+    lens = round(totals['length']/totals['count'], 4)
 
+    if return_histograms:
+        return em, lens, get_length_histograms(lengths)
+    return em, lens
 
-def eval_dialogue_system(infile):
 
-    lines = open(infile, 'r').readlines()[1:]
+def _score_dialogue_chunk(lines):
 
-    f1_scores = []
-    rl_scores = []
-    answer_lengths = []
+    totals, lengths = Counter(), Counter()
     for line in lines:
         line = json.loads(line)
-        answer = line['answer'] if line.get('answer') is not None else line('adversarial_answer')
+        answer = _get_answer(line)
         output = line['output'][0]
 
-        f1_scores.append(f1(output, answer))
-        rl_scores.append(rl(output, answer))
-        answer_lengths.append(len(output.split()))
+        totals['count'] += 1
+        totals['f1'] += f1(output, answer)
+        totals['rl'] += rl(output, answer)
+        totals['length'] += len(output.split())
+        lengths[(line.get('category'), len(output.split()))] += 1
+    return totals, lengths
 
-    F1 = round(np.mean(f1_scores), 4)
-    RL = round(np.mean(rl_scores), 4)
-    lens = round(np.mean(answer_lengths), 4)
 
-    return F1, RL, lens
+def eval_dialogue_system(infile, num_workers=None, return_histograms=False):
+
+    totals, lengths = run_chunked(infile, _score_dialogue_chunk, num_workers)
+    F1 = round(totals['f1']/totals['count'], 4)
+    RL = round(totals['rl']/totals['count'], 4)
+    lens = round(totals['length']/totals['count'], 4)
 
+    if return_histograms:
+        return F1, RL, lens, get_length_histograms(lengths)
+    return F1, RL, lens
@@ -1,29 +1,30 @@
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
 import os, json
 import math
 from tqdm import tqdm
 from collections import defaultdict
+from task_eval.data_utils import get_conversation, load_samples
 
 
 def get_conversation_lengths(data, encoder=None):
 
     total_conv_length = 0
     id2length = {}
-    for sess_num in range(1, 50):
-        if 'session_%s' % sess_num not in data:
-            continue
-        if data['session_%s' % sess_num] == []:
-            continue
-
-        for dialog in data['session_%s' % sess_num]:
-            dialog_tokens = dialog['speaker'] + ': ' + dialog['text'] + '\n'
-            if "img_file" in dialog and len(dialog["img_file"]) > 0:
-                dialog_tokens += '[shares %s]\n' % dialog["blip_caption"]
+    for session in get_conversation(data).sessions:
+
+        for turn in session.turns:
+            dialog_tokens = turn.speaker + ': ' + turn.text + '\n'
+            if turn.has_image():
+                dialog_tokens += '[shares %s]\n' % turn.blip_caption
             if encoder is not None:
                 dialog_length = len(encoder.encode(dialog_tokens))
             else:
                 # dialog_length = len(dialog_tokens.split())
                 dialog_length = len(dialog_tokens)
-            id2length[dialog["dia_id"]] = total_conv_length + dialog_length
+            id2length[turn.dia_id] = total_conv_length + dialog_length
             total_conv_length += dialog_length
     return id2length
 
@@ -39,12 +40,12 @@ def analyze_aggr_acc(ann_file, in_file, out_file, model_name, metric_key, encode
     recall_by_category = defaultdict(lambda: 0)
 
     outputs = {d['sample_id']: d for d in json.load(open(in_file))}
-    data = {d['sample_id']: d for d in json.load(open(ann_file))}
+    data = load_samples(ann_file)
     sample_ids = outputs.keys()
     
     for sample_id in sample_ids:
         output = outputs[sample_id]
-        ann = data[sample_id]
+        ann = data.get(sample_id)
 
         id2length = get_conversation_lengths(ann['conversation'], encoder)
         # print(id2length)
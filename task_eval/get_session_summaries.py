@@ -7,8 +7,10 @@ import argparse
 import os, json
 from generative_agents.memory_utils import get_session_facts
 from global_methods import set_openai_key, run_chatgpt
+from llm_cache import print_llm_cache_stats
+from task_eval.data_utils import get_conversation, load_samples
 from task_eval.rag_utils import get_embeddings
-import pickle
+from task_eval.store_utils import append_to_embedding_store, compact_embedding_store
 
 def parse_args():
 
@@ -57,7 +59,7 @@ def main():
     args = parse_args()
 
     # load conversations
-    samples = json.load(open(args.data_file))
+    samples = load_samples(args.data_file)
 
     # load the output file if it exists to check for overwriting
     if os.path.exists(args.out_file):
@@ -77,38 +79,43 @@ def main():
         else:
             output = {'sample_id': data['sample_id']}
 
-        session_nums = [int(k.split('_')[-1]) for k in data['conversation'].keys() if 'session' in k and 'date_time' not in k]
-        for i in tqdm(range(min(session_nums), max(session_nums) + 1), desc='Generating summaries for %s' % data['sample_id']):
+        for session in tqdm(get_conversation(data['conversation']).sessions, desc='Generating summaries for %s' % data['sample_id']):
+
+            i = session.num
 
             # get the summaries
             if 'session_%s_summary' % i not in output or args.overwrite:
-                summary = get_session_summary(data['conversation']['session_%s' % i], data['conversation']['session_%s_date_time' % i])
+                summary = get_session_summary(session.raw, session.date_time)
                 output['session_%s_summary' % i] = summary
             else:
                 summary = output['session_%s_summary' % i]
 
-            date_time = data['conversation']['session_%s_date_time' % i]
+            date_time = session.date_time
             summaries.append(summary)
             date_times.append(date_time)
             context_ids.append('S%s'%i)
 
-            print("Getting embeddings for %s summaries" % len(summaries))
-            embeddings = get_embeddings(args.retriever, summaries, 'context')
-            assert embeddings.shape[0] == len(summaries)
-            database = {'embeddings': embeddings,
-                                'date_time': date_times,
-                                'dia_id': context_ids,
-                                'context': summaries}
-
+        # embed all summaries of the sample at once
+        print("Getting embeddings for %s summaries" % len(summaries))
+        embeddings = get_embeddings(args.retriever, summaries, 'context')
+        assert embeddings.shape[0] == len(summaries)
+        database = {'embeddings': embeddings,
+                            'date_time': date_times,
+                            'dia_id': context_ids,
+                            'context': summaries}
 
-        with open(args.out_file.replace('.json', '_%s.pkl' % data['sample_id']), 'wb') as f:
-            pickle.dump(database, f)
+        # all samples share one memory-mapped embedding store next to the output file
+        append_to_embedding_store(args.out_file.replace('.json', ''), data['sample_id'], database)
 
         out_samples[output['sample_id']] = output.copy()
     
     with open(args.out_file, 'w') as f:
         json.dump(list(out_samples.values()), f, indent=2)
 
+    # drop rows left behind by samples that were regenerated
+    compact_embedding_store(args.out_file.replace('.json', ''))
+    print_llm_cache_stats()
+
 
 main()
 
@@ -4,18 +4,25 @@ sys.path.insert(0, str(Path(__file__).parent.parent))
 
 import random
 import os, json
+import copy
 from tqdm import tqdm
 from transformers import AutoTokenizer
 import transformers
 import torch
 import huggingface_hub
 
-from task_eval.rag_utils import build_bm25s_index_from_data, bm25s_retrieve_topk
+from task_eval.rag_utils import get_bm25s_index, bm25s_retrieve_topk
+from task_eval.rag_utils import get_rag_retrieval, get_context_ids
+from task_eval.context_utils import get_context_builder, pack_by_token_budget, HF_LAYOUT
+from task_eval.data_utils import get_conversation
+from task_eval.journal_utils import get_pending_idxs
 
 from transformers import (
     AutoTokenizer,
     AutoModelForCausalLM,
     BitsAndBytesConfig,
+    StoppingCriteria,
+    StoppingCriteriaList,
 )
 import torch
 import huggingface_hub
@@ -88,12 +95,30 @@ GEMMA_INSTRUCT_PROMPT = """
 {}<end_of_turn>
 """
 
+HF_SYSTEM_MESSAGE = "You are a helpful, respectful and honest assistant whose job is to understand the following conversation and answer questions based on the conversation. If you don't know the answer to a question, please don't share false information."
+
+RAG_START_PROMPT = "Below are excerpts retrieved from a conversation between two people: {} and {}. The date of each excerpt is written at its beginning.\n\n"
+
 CONV_START_PROMPT = "Below is a conversation between two people: {} and {}. The conversation takes place over multiple days and the date of each conversation is wriiten at the beginning of the conversation.\n\n"
 
 ANS_TOKENS_PER_QUES = 50
+HF_SAMPLING_KWARGS = {'do_sample': True, 'top_k': 10, 'temperature': 0.4, 'top_p': 0.9}
 
+# Stop conditions per model family, matched against model_name like get_hf_query.
+# Only the first line of an answer is kept (see get_hf_prediction), so generation ends at the
+# first stop string once the answer has started. 'max_new_tokens' sets per-category answer
+# budgets; categories without an entry get ANS_TOKENS_PER_QUES. For prompts that ask for a
+# json dictionary of answers, add '}' to the stop strings.
+HF_STOPPING = {
+    'default': {'stop_strings': ['\n'], 'max_new_tokens': {5: 16}},
+    'gemma': {'stop_strings': ['\n', '<end_of_turn>'], 'max_new_tokens': {5: 16}},
+}
+
+# bm25s results of the current conversation at the largest k of a top-k sweep
+_BM25S_RESULTS = {}
 
-def run_mistral(pipeline, question, data, tokenizer, args):
+
+def get_mistral_query(question, data, tokenizer, args):
 
     question_prompt =  QA_PROMPT.format(question)
     query_conv = get_input_context(data['conversation'], MISTRAL_INSTRUCT_SYSTEM_PROMPT.format(question_prompt), tokenizer, args)
@@ -101,25 +126,10 @@ def run_mistral(pipeline, question, data, tokenizer, args):
     # without chat_template
     # query = MISTRAL_INSTRUCT_SYSTEM_PROMPT.format(query_conv + '\n\n' + question_prompt)
     # with chat template
-    query = tokenizer.apply_chat_template([{"role": "user", "content": query_conv + '\n\n' + question_prompt}], tokenize=False, add_generation_prompt=True)
-
-    sequences = pipeline(
-                        query,
-                        # max_length=8000,
-                        max_new_tokens=args.batch_size*ANS_TOKENS_PER_QUES,
-                        pad_token_id=tokenizer.pad_token_id,
-                        eos_token_id=tokenizer.eos_token_id,
-                        do_sample=True,
-                        top_k=10,
-                        temperature=0.4,
-                        top_p=0.9,
-                        return_full_text=False,
-                        num_return_sequences=1,
-                        )
-    return sequences[0]['generated_text']
+    return tokenizer.apply_chat_template([{"role": "user", "content": query_conv + '\n\n' + question_prompt}], tokenize=False, add_generation_prompt=True)
 
 
-def run_gemma(pipeline, question, data, tokenizer, args):
+def get_gemma_query(question, data, tokenizer, args):
 
     question_prompt =  QA_PROMPT.format(question)
     query_conv = get_input_context(data['conversation'], GEMMA_INSTRUCT_PROMPT.format(question_prompt), tokenizer, args)
@@ -127,25 +137,10 @@ def run_gemma(pipeline, question, data, tokenizer, args):
     # without chat_template
     # query = MISTRAL_INSTRUCT_SYSTEM_PROMPT.format(query_conv + '\n\n' + question_prompt)
     # with chat template
-    query = tokenizer.apply_chat_template([{"role": "user", "content": query_conv + '\n\n' + question_prompt}], tokenize=False, add_generation_prompt=True)
-
-    sequences = pipeline(
-                        query,
-                        # max_length=8000,
-                        max_new_tokens=args.batch_size*ANS_TOKENS_PER_QUES,
-                        pad_token_id=tokenizer.pad_token_id,
-                        eos_token_id=tokenizer.eos_token_id,
-                        do_sample=True,
-                        top_k=10,
-                        temperature=0.4,
-                        top_p=0.9,
-                        return_full_text=False,
-                        num_return_sequences=1,
-                        )
-    return sequences[0]['generated_text']
+    return tokenizer.apply_chat_template([{"role": "user", "content": query_conv + '\n\n' + question_prompt}], tokenize=False, add_generation_prompt=True)
 
 
-def run_llama(pipeline, question, data, tokenizer, args):
+def get_llama_query(question, data, tokenizer, args):
 
     question_prompt =  QA_PROMPT.format(question)
     query_conv = get_input_context(data['conversation'], LLAMA3_CHAT_SYSTEM_PROMPT.format(question_prompt), tokenizer, args)
@@ -153,25 +148,198 @@ def run_llama(pipeline, question, data, tokenizer, args):
     # without chat_template
     # query = MISTRAL_INSTRUCT_SYSTEM_PROMPT.format(query_conv + '\n\n' + question_prompt)
     # with chat template
-    query = tokenizer.apply_chat_template([{"role": "system", "content": "You are a helpful, respectful and honest assistant whose job is to understand the following conversation and answer questions based on the conversation. If you don't know the answer to a question, please don't share false information."},
-                                           {"role": "user", "content": query_conv + '\n\n' + question_prompt}], tokenize=False, add_generation_prompt=True)
+    return tokenizer.apply_chat_template([{"role": "system", "content": HF_SYSTEM_MESSAGE},
+                                          {"role": "user", "content": query_conv + '\n\n' + question_prompt}], tokenize=False, add_generation_prompt=True)
+
+
+def get_hf_query(question, data, tokenizer, model_name, args):
+
+    if 'mistral' in model_name:
+        return get_mistral_query(question, data, tokenizer, args)
+    elif 'llama' in model_name:
+        return get_llama_query(question, data, tokenizer, args)
+    elif 'gemma' in model_name:
+        return get_gemma_query(question, data, tokenizer, args)
+    elif 'Qwen' in model_name:
+        return get_llama_query(question, data, tokenizer, args)
+    else:
+        raise NotImplementedError
+
+
+class AnswerStoppingCriteria(StoppingCriteria):
+    """
+    Ends each sequence of a batch once its generated text contains a stop string after the
+    answer has started, or once it has used its own token budget.
+    """
+
+    def __init__(self, tokenizer, stop_strings, budgets):
+        self.tokenizer = tokenizer
+        self.stop_strings = stop_strings
+        self.budgets = budgets
+        self.prompt_length = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+
+        # first call comes right after the first new token
+        if self.prompt_length is None:
+            self.prompt_length = input_ids.shape[1] - 1
+        num_generated = input_ids.shape[1] - self.prompt_length
+
+        done = []
+        for row, budget in zip(input_ids, self.budgets):
+            # special tokens are kept so that turn markers can be used as stop strings
+            text = self.tokenizer.decode(row[self.prompt_length:], skip_special_tokens=False).lstrip()
+            done.append(num_generated >= budget or any([stop in text for stop in self.stop_strings]))
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+def get_stopping_config(model_name):
+
+    for family, config in HF_STOPPING.items():
+        if family != 'default' and family in model_name:
+            return config
+    return HF_STOPPING['default']
+
+
+def get_answer_budget(category, model_name):
+    return get_stopping_config(model_name)['max_new_tokens'].get(category, ANS_TOKENS_PER_QUES)
+
+
+def get_stopping_criteria(tokenizer, budgets, model_name):
+    return StoppingCriteriaList([AnswerStoppingCriteria(tokenizer, get_stopping_config(model_name)['stop_strings'], budgets)])
+
+
+def run_hf_pipeline(pipeline, query, tokenizer, args, budget=ANS_TOKENS_PER_QUES, model_name=''):
 
     sequences = pipeline(
                         query,
                         # max_length=8000,
-                        max_new_tokens=args.batch_size*ANS_TOKENS_PER_QUES,
+                        max_new_tokens=budget,
+                        stopping_criteria=get_stopping_criteria(tokenizer, [budget], model_name),
                         pad_token_id=tokenizer.pad_token_id,
                         eos_token_id=tokenizer.eos_token_id,
-                        do_sample=True,
-                        top_k=10,
-                        temperature=0.4,
-                        top_p=0.9,
                         return_full_text=False,
                         num_return_sequences=1,
+                        **HF_SAMPLING_KWARGS
                         )
     return sequences[0]['generated_text']
 
 
+def run_hf_batch(pipeline, queries, args, budgets, model_name):
+
+    # one prompt per question; prompts of similar length are batched together to limit padding
+    model, tokenizer = pipeline.model, pipeline.tokenizer
+    if tokenizer.pad_token_id is None:
+        tokenizer.pad_token_id = tokenizer.eos_token_id
+    tokenizer.padding_side = 'left' # generated tokens must directly follow every prompt
+
+    # chat templates already contain the special tokens
+    input_ids = [tokenizer.encode(query, add_special_tokens=False) for query in queries]
+    order = sorted(range(len(queries)), key=lambda i: len(input_ids[i]), reverse=True)
+
+    answers = [None] * len(queries)
+    for batch_start_idx in tqdm(range(0, len(order), args.batch_size), desc='Generating answers'):
+        batch = order[batch_start_idx:batch_start_idx + args.batch_size]
+        inputs = tokenizer.pad({'input_ids': [input_ids[i] for i in batch]}, return_tensors='pt').to(model.device)
+        batch_budgets = [budgets[i] for i in batch]
+        with torch.no_grad():
+            outputs = model.generate(**inputs,
+                                     max_new_tokens=max(batch_budgets),
+                                     stopping_criteria=get_stopping_criteria(tokenizer, batch_budgets, model_name),
+                                     pad_token_id=tokenizer.pad_token_id,
+                                     eos_token_id=tokenizer.eos_token_id,
+                                     **HF_SAMPLING_KWARGS)
+        texts = tokenizer.batch_decode(outputs[:, inputs['input_ids'].shape[1]:], skip_special_tokens=True)
+        for i, text in zip(batch, texts):
+            answers[i] = text
+    return answers
+
+
+def get_hf_prefix_queries(questions, data, tokenizer, model_name, args):
+
+    # the conversation is truncated once, for the longest question, so that every prompt
+    # starts with the same prefix and differs only after the conversation
+    question_tokens = [len(tokenizer.encode(QA_PROMPT.format(q))) for q in questions]
+    longest = questions[question_tokens.index(max(question_tokens))]
+    query = get_hf_query(longest, data, tokenizer, model_name, args)
+    # llama and gemma chat templates strip the message content, so the question prompt is
+    # located without its surrounding newlines; whatever the template kept goes with the split
+    question_prompt = QA_PROMPT.format(longest).strip()
+    split = query.rindex(question_prompt)
+    prefix, end = query[:split], query[split + len(question_prompt):]
+    return prefix, [QA_PROMPT.format(q).strip() + end for q in questions]
+
+
+def get_hf_rag_query(question, contexts, data, tokenizer, model_name):
+
+    # retrieval-only prompt: instruction, retrieved turns and question, without the conversation
+    speakers_names = get_conversation(data['conversation']).speaker_names
+    content = RAG_START_PROMPT.format(speakers_names[0], speakers_names[1]) + '\n'.join(contexts) + '\n\n' + QA_PROMPT.format(question)
+
+    if 'mistral' in model_name or 'gemma' in model_name:
+        messages = [{"role": "user", "content": content}]
+    elif 'llama' in model_name or 'Qwen' in model_name:
+        messages = [{"role": "system", "content": HF_SYSTEM_MESSAGE}, {"role": "user", "content": content}]
+    else:
+        raise NotImplementedError
+    return tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+
+
+def report_prompt_lengths(lengths, full_context_length=None):
+
+    print("Prompt length: %.1f tokens on average over %s questions (max %s)" % (sum(lengths) / len(lengths), len(lengths), max(lengths)))
+    if full_context_length is not None:
+        print("Full-context prompt: %s tokens; retrieval-only prompts are %.1f%% shorter" % (full_context_length, 100 * (1 - sum(lengths) / len(lengths) / full_context_length)))
+
+
+def run_hf_prefix_cached(pipeline, prefix, suffixes, args, budgets, model_name):
+
+    # the prefix is prefilled once; every question starts from a copy of its KV cache
+    model, tokenizer = pipeline.model, pipeline.tokenizer
+    prefix_ids = tokenizer(prefix, return_tensors='pt', add_special_tokens=False).input_ids.to(model.device)
+    with torch.no_grad():
+        prefix_cache = model(input_ids=prefix_ids, use_cache=True).past_key_values
+
+    answers = []
+    num_uncached = 0
+    for suffix, budget in tqdm(zip(suffixes, budgets), total=len(suffixes), desc='Generating answers'):
+        # the full prompt is tokenized once and split on token ids, so the input is the same as
+        # without the cache; if merges across the seam change the prefix tokens, the cache does
+        # not match and the question is generated from the full prompt instead
+        input_ids = tokenizer(prefix + suffix, return_tensors='pt', add_special_tokens=False).input_ids.to(model.device)
+        suffix_ids = input_ids[:, prefix_ids.shape[1]:]
+        if suffix_ids.shape[1] > 0 and torch.equal(torch.cat([prefix_ids, suffix_ids], dim=1), input_ids):
+            cache_kwargs = {'past_key_values': copy.deepcopy(prefix_cache)} # generate extends the cache in place
+        else:
+            cache_kwargs = {}
+            num_uncached += 1
+        with torch.no_grad():
+            outputs = model.generate(input_ids=input_ids,
+                                     attention_mask=torch.ones_like(input_ids),
+                                     **cache_kwargs,
+                                     max_new_tokens=budget,
+                                     stopping_criteria=get_stopping_criteria(tokenizer, [budget], model_name),
+                                     pad_token_id=tokenizer.pad_token_id,
+                                     eos_token_id=tokenizer.eos_token_id,
+                                     **HF_SAMPLING_KWARGS)
+        answers.append(tokenizer.decode(outputs[0, input_ids.shape[1]:], skip_special_tokens=True))
+    if num_uncached > 0:
+        print("Prefix cache did not match the tokenized prompt for %s of %s questions; generated them without it" % (num_uncached, len(suffixes)))
+    return answers
+
+
+def run_mistral(pipeline, question, data, tokenizer, args):
+    return run_hf_pipeline(pipeline, get_mistral_query(question, data, tokenizer, args), tokenizer, args)
+
+
+def run_gemma(pipeline, question, data, tokenizer, args):
+    return run_hf_pipeline(pipeline, get_gemma_query(question, data, tokenizer, args), tokenizer, args)
+
+
+def run_llama(pipeline, question, data, tokenizer, args):
+    return run_hf_pipeline(pipeline, get_llama_query(question, data, tokenizer, args), tokenizer, args)
+
+
 def get_chatgpt_summaries(ann_file):
 
     data = json.load(open(ann_file))
@@ -189,45 +357,62 @@ def get_input_context(data, question_prompt, encoding, args):
     question_tokens = len(encoding.encode(question_prompt))
 
     # start instruction prompt
-    speakers_names = list(set([d['speaker'] for d in data['session_1']]))
+    speakers_names = get_conversation(data).speaker_names
     start_prompt = CONV_START_PROMPT.format(speakers_names[0], speakers_names[1])
     start_tokens = len(encoding.encode(start_prompt))
 
-    query_conv = ''
-    total_tokens = 0
-    min_session = -1
-    stop = False
-    session_nums = [int(k.split('_')[-1]) for k in data.keys() if 'session' in k and 'date_time' not in k]
-    for i in range(min(session_nums), max(session_nums) + 1):
-        if 'session_%s' % i in data:
-            for dialog in data['session_%s' % i][::-1]:
-                turn = ''
-                turn = dialog['speaker'] + ' said, \"' + dialog['text'] + '\"' + '\n'
-                if "blip_caption" in dialog:
-                    turn += ' and shared %s.' % dialog["blip_caption"]
-                turn += '\n'
-
-                # get an approximate estimate of where to truncate conversation to fit into contex window
-                dynamic_max_len = getattr(encoding, "model_max_length", 4096)
-                new_tokens = len(encoding.encode('DATE: ' + data['session_%s_date_time' % i] + '\n' + 'CONVERSATION:\n' + turn))
-                if (start_tokens + new_tokens + total_tokens + question_tokens) < (dynamic_max_len-(ANS_TOKENS_PER_QUES*args.batch_size)): # if new turns still fit into context window, add to query
-                    query_conv = turn + query_conv
-                    total_tokens += len(encoding.encode(turn))
-                else:
-                    min_session = i
-                    stop = True
-                    break
-
-            query_conv = '\nDATE: ' + data['session_%s_date_time' % i] + '\n' + 'CONVERSATION:\n' + query_conv
-        
-        if stop:
-            break
-    
+    # get an approximate estimate of where to truncate conversation to fit into contex window
+    dynamic_max_len = getattr(encoding, "model_max_length", 4096)
+    builder = get_context_builder(data, encoding, HF_LAYOUT)
+    query_conv = builder.build(start_tokens + question_tokens, dynamic_max_len-ANS_TOKENS_PER_QUES)
+
     query_conv = start_prompt + query_conv
 
     return query_conv
 
 
+def get_hf_question(qa):
+
+    # pre-processing steps for Temporal (2) and Adversarial (5) categories
+    if qa['category'] == 2:
+        return qa['question'] + ' Use DATE of CONVERSATION to answer with an approximate date.', None
+    elif qa['category'] == 5:
+        question = qa['question'] + " (a) {} (b) {}. Select the correct answer by writing (a) or (b)."
+        if random.random() < 0.5:
+            if qa.get('answer') is not None:
+                question = question.format('No information available', qa['answer'])
+                answer = {'a': 'No information available', 'b': qa['answer']}
+            else:
+                question = question.format('No information available', qa['adversarial_answer'])
+                answer = {'a': 'No information available', 'b': qa['adversarial_answer']}
+        else:
+            if qa.get('answer') is not None:
+                question = question.format(qa['answer'], 'No information available')
+                answer = {'b': 'No information available', 'a': qa['answer']}
+            else:
+                question = question.format(qa['adversarial_answer'], 'No information available')
+                answer = {'b': 'No information available', 'a': qa['adversarial_answer']}
+        # questions.append(qa['question'] + " Write NOT ANSWERABLE if the question cannot be answered.")
+        return question, answer
+    else:
+        return qa['question'], None
+
+
+def get_hf_prediction(answer, cat_5_answer=None):
+
+    # post process answers, necessary for Adversarial Questions
+    answer = answer.replace('\\"', "'").strip()
+    answer = [w.strip() for w in answer.split('\n') if not w.strip().isspace()][0]
+    if cat_5_answer is not None:
+        answer = answer.lower().strip()
+        if '(a)' in answer:
+            return cat_5_answer['a']
+        else:
+            return cat_5_answer['b']
+    else:
+        return answer.lower().replace('(a)', '').replace('(b)', '').replace('a)', '').replace('b)', '').replace('answer:', '').strip()
+
+
 def get_hf_answers(in_data, out_data, args, pipeline, model_name):
 
     # 与 evaluate_qa.py 保持一致，否则统计用不到 RAG 的 key
@@ -244,109 +429,104 @@ def get_hf_answers(in_data, out_data, args, pipeline, model_name):
     else:
         encoding = AutoTokenizer.from_pretrained(model_name)
 
-    for batch_start_idx in range(0, len(in_data['qa']) + args.batch_size, args.batch_size):
-
-        questions = []
-        include_idxs = []
-        cat_5_idxs = []
-        cat_5_answers = []
-        for i in range(batch_start_idx, batch_start_idx + args.batch_size):
-
-            # end if all questions have been included
-            if i>=len(in_data['qa']):
-                break
-            qa = in_data['qa'][i]
-            # # skip if already predicted and overwrite is set to False
-            # if '%s_prediction' % args.model not in qa or args.overwrite:
-            #     include_idxs.append(i)
-            # else:
-            #     print("Skipping -->", qa['question'])
-            #     continue
-            # # skip if already predicted and overwrite is set to False
-            if (prediction_key not in qa) or args.overwrite:
-                include_idxs.append(i)
-            else:
-                print("Skipping -->", qa['question'])
-                continue
-
-            # pre-processing steps for Temporal (2) and Adversarial (5) categories
-            if qa['category'] == 2:
-                questions.append(qa['question'] + ' Use DATE of CONVERSATION to answer with an approximate date.')
-            elif qa['category'] == 5:
-                question = qa['question'] + " (a) {} (b) {}. Select the correct answer by writing (a) or (b)."
-                if random.random() < 0.5:
-                    if qa.get('answer') is not None:
-                        question = question.format('No information available', qa['answer'])
-                        answer = {'a': 'No information available', 'b': qa['answer']}
-                    else:
-                        question = question.format('No information available', qa['adversarial_answer'])
-                        answer = {'a': 'No information available', 'b': qa['adversarial_answer']}
-                else:
-                    if qa.get('answer') is not None:
-                        question = question.format(qa['answer'], 'No information available')
-                        answer = {'b': 'No information available', 'a': qa['answer']}
-                    else:
-                        question = question.format(qa['adversarial_answer'], 'No information available')
-                        answer = {'b': 'No information available', 'a': qa['adversarial_answer']}
-                cat_5_idxs.append(len(questions))
-                questions.append(question)
-                cat_5_answers.append(answer)
-                # questions.append(qa['question'] + " Write NOT ANSWERABLE if the question cannot be answered.")
-            else:
-                questions.append(qa['question'])
-
-        if questions == []:
+    # bm25s index is built once per conversation and shared by all of its questions
+    use_bm25 = args.use_rag and args.retriever and args.retriever.lower() in ['bm25', 'bm25s']
+    if use_bm25:
+        mode = getattr(args, "rag_mode", "dialog")
+        retr, doc_texts, doc_ids = get_bm25s_index(in_data['conversation'], in_data['sample_id'], mode=mode,
+                                                   index_dir=getattr(args, "index_dir", ""))
+        # retrieval for a top-k sweep runs once per question at the largest k and is sliced for smaller k
+        max_top_k = getattr(args, "max_top_k", args.top_k)
+        retrieval_key = (in_data['sample_id'], mode, max_top_k)
+        if retrieval_key not in _BM25S_RESULTS:
+            _BM25S_RESULTS.clear()
+            _BM25S_RESULTS[retrieval_key] = {}
+        retrieved = _BM25S_RESULTS[retrieval_key]
+    elif args.use_rag:
+        # dense and hybrid retrievers share the embedding databases and retrieval of the gpt backend
+        context_database, top_idxs = get_rag_retrieval(args, in_data)
+
+    # prompts are prepared for every question first, then generated one at a time or in batches
+    include_idxs = []
+    model_questions = []
+    rag_contexts = []
+    budgets = []
+    cat_5_answers = []
+    context_ids = []
+    pending = set(get_pending_idxs(out_data, prediction_key, args.overwrite))
+    for i, qa in enumerate(in_data['qa']):
+
+        # # skip if already predicted (in the output file or the journal) and overwrite is set to False
+        if i in pending:
+            include_idxs.append(i)
+        else:
             continue
 
+        question, cat_5_answer = get_hf_question(qa)
+        q_for_model = question
+        ctx_ids = []
 
-        if args.batch_size == 1:
-
-            raw_question = questions[0]
-            q_for_model = raw_question
-            ctx_ids = []
-
-            # 2) RAG：bm25/bm25s 上下文拼接
-            if args.use_rag and args.retriever and args.retriever.lower() in ['bm25', 'bm25s']:
-                mode = getattr(args, "rag_mode", "dialog")  # 'lucene'/'bm25+'/'bm25l'/'atire'/'robertson'
-                retr, doc_texts, doc_ids = build_bm25s_index_from_data(in_data['conversation'], mode=mode)
+        # 2) RAG：bm25/bm25s 上下文拼接
+        if args.use_rag:
+            if use_bm25:
                 # bm25s: 先 index(tokenize(corpus))，再 retrieve(tokenize(query), k) :contentReference[oaicite:0]{index=0}
-                top_ctx = bm25s_retrieve_topk(retr, raw_question, doc_texts, doc_ids, args.top_k)
-                ctx_ids = [c.get("id", "") for c in top_ctx]
-                ctx_block = "CONTEXT (Top-{}):\n{}\n\n".format(
-                    args.top_k, "\n".join(c.get("text", "") for c in top_ctx)
-                )
-                q_for_model = ctx_block + raw_question
-
-            if 'mistral' in model_name:
-                answer = run_mistral(pipeline, q_for_model, in_data, encoding, args)
-            elif 'llama' in model_name:
-                answer = run_llama(pipeline, q_for_model, in_data, encoding, args)
-            elif 'gemma' in model_name:
-                answer = run_gemma(pipeline, q_for_model, in_data, encoding, args)
-            elif 'Qwen' in model_name:
-                answer = run_llama(pipeline, q_for_model, in_data, encoding, args)
+                if i not in retrieved:
+                    retrieved[i] = bm25s_retrieve_topk(retr, question, doc_texts, doc_ids,
+                                                       min(max_top_k, len(doc_texts)))
+                top_ctx = retrieved[i]
             else:
-                raise NotImplementedError
-            
-            print(q_for_model, answer)
-
-            # post process answers, necessary for Adversarial Questions
-            answer = answer.replace('\\"', "'").strip()
-            answer = [w.strip() for w in answer.split('\n') if not w.strip().isspace()][0]
-            if len(cat_5_idxs) > 0:
-                answer = answer.lower().strip()
-                if '(a)' in answer:
-                    answer = cat_5_answers[0]['a']
-                else:
-                    answer = cat_5_answers[0]['b']
+                top_ctx = [{"text": context_database['date_time'][j] + ': ' + context_database['context'][j],
+                            "date_time": context_database['date_time'][j],
+                            "position": int(j)} for j in top_idxs[i]]
+            # the budget replaces top_k: the whole ranked list (largest k of the sweep) is packed
+            if getattr(args, "context_budget", 0) > 0:
+                top_ctx = pack_by_token_budget(top_ctx, encoding, args.context_budget, args.dedup_threshold, args.chronological)
             else:
-                answer = answer.lower().replace('(a)', '').replace('(b)', '').replace('a)', '').replace('b)', '').replace('answer:', '').strip()
-            out_data['qa'][batch_start_idx][prediction_key] = answer
-            if args.use_rag:
-                out_data['qa'][batch_start_idx][prediction_key + "_context"] = ctx_ids
+                top_ctx = top_ctx[:args.top_k]
+            if use_bm25:
+                ctx_ids = [c.get("id", "") for c in top_ctx]
+            else:
+                ctx_ids = get_context_ids(context_database, [c["position"] for c in top_ctx])
+            ctx_block = "CONTEXT (Top-{}):\n{}\n\n".format(
+                len(top_ctx) if getattr(args, "context_budget", 0) > 0 else args.top_k, "\n".join(c.get("text", "") for c in top_ctx)
+            )
+            q_for_model = ctx_block + question
+            rag_contexts.append((question, [c.get("text", "") for c in top_ctx]))
+
+        model_questions.append(q_for_model)
+        budgets.append(get_answer_budget(qa['category'], model_name))
+        cat_5_answers.append(cat_5_answer)
+        context_ids.append(ctx_ids)
+
+    # RAG prompts hold only the retrieved turns unless the full conversation is requested as well
+    rag_only = len(rag_contexts) > 0 and not getattr(args, 'rag_full_context', False)
+
+    if len(model_questions) == 0:
+        answers = []
+    elif getattr(args, 'prefix_cache', False) and not rag_only:
+        prefix, suffixes = get_hf_prefix_queries(model_questions, in_data, encoding, model_name, args)
+        report_prompt_lengths([len(encoding.encode(prefix + suffix, add_special_tokens=False)) for suffix in suffixes])
+        answers = run_hf_prefix_cached(pipeline, prefix, suffixes, args, budgets, model_name)
+    else:
+        if rag_only:
+            queries = [get_hf_rag_query(question, contexts, in_data, encoding, model_name) for question, contexts in rag_contexts]
+            full_query = get_hf_query(model_questions[0], in_data, encoding, model_name, args)
+            full_context_length = len(encoding.encode(full_query, add_special_tokens=False))
+        else:
+            queries = [get_hf_query(q, in_data, encoding, model_name, args) for q in model_questions]
+            full_context_length = None
+        report_prompt_lengths([len(encoding.encode(query, add_special_tokens=False)) for query in queries], full_context_length)
+        if args.batch_size == 1:
+            answers = [run_hf_pipeline(pipeline, query, encoding, args, budget, model_name)
+                       for query, budget in tqdm(zip(queries, budgets), total=len(queries), desc='Generating answers')]
+        else:
+            answers = run_hf_batch(pipeline, queries, args, budgets, model_name)
+
+    for idx, answer, cat_5_answer, ctx_ids in zip(include_idxs, answers, cat_5_answers, context_ids):
 
-        else:            
-            raise NotImplementedError
+        out_data['qa'][idx][prediction_key] = get_hf_prediction(answer, cat_5_answer)
+        if args.use_rag:
+            out_data['qa'][idx][prediction_key + "_context"] = ctx_ids
 
     return out_data
 
@@ -463,3 +643,14 @@ def init_hf_model(args):
     print("Loaded model")
     return pipeline, model_name
 
+
+def init_hf_backend(args):
+
+    # see task_eval/backend_utils.py
+    pipeline, model_name = init_hf_model(args)
+
+    def answer(data, out_data, prediction_key, args):
+        # get_hf_answers derives the same prediction key from args
+        return get_hf_answers(data, out_data, args, pipeline, model_name)
+
+    return answer
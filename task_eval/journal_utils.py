@@ -0,0 +1,129 @@
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import os, json
+import time
+from collections import defaultdict
+
+
+# Append-only journal of QA predictions written while evaluate_qa.py runs, one JSON line per
+# prediction: sample_id, qa_index, prediction_key, prediction, context (retrieved ids for RAG),
+# latency (seconds of the call) and tokens (estimated prompt + completion tokens of the call).
+# Lines are fsynced in batches; on restart the journal is replayed into the outputs so that
+# finished questions are skipped, and it is removed once the final output file is written.
+
+JOURNAL_FSYNC_EVERY = 32 # records
+JOURNAL_FSYNC_SECONDS = 5.0
+
+
+def get_journal_file(out_file):
+    # built from the extension only, so the journal never resolves to the output file itself
+    return os.path.splitext(out_file)[0] + '_journal.jsonl'
+
+
+def get_pending_idxs(out_data, prediction_key, overwrite=False):
+    # questions still to answer; predictions replayed from the journal live in out_data, which is
+    # built from the output file when it exists and does not share dicts with the input data
+    return [i for i, qa in enumerate(out_data['qa']) if prediction_key not in qa or overwrite]
+
+
+def resume_out_data(data, out_samples, journal):
+
+    # output of one sample: predictions of an existing output file, then those of the journal
+    out_data = {'sample_id': data['sample_id']}
+    if data['sample_id'] in out_samples:
+        out_data['qa'] = out_samples[data['sample_id']]['qa'].copy()
+    else:
+        out_data['qa'] = data['qa'].copy()
+    return journal.replay(out_data)
+
+
+def read_journal(path):
+
+    # a crash can leave a torn last line; everything up to the last newline is kept
+    records = []
+    valid_bytes = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                break
+            valid_bytes += len(line)
+    return records, valid_bytes
+
+
+class PredictionJournal(object):
+
+    def __init__(self, path, fsync_every=JOURNAL_FSYNC_EVERY, fsync_seconds=JOURNAL_FSYNC_SECONDS):
+
+        self.path = path
+        self.fsync_every = fsync_every
+        self.fsync_seconds = fsync_seconds
+        self.replayed = defaultdict(list)
+
+        if os.path.exists(path):
+            records, valid_bytes = read_journal(path)
+            for record in records:
+                self.replayed[record['sample_id']].append(record)
+            if valid_bytes < os.path.getsize(path):
+                with open(path, 'r+b') as f:
+                    f.truncate(valid_bytes)
+            print("Replaying %s predictions from %s" % (len(records), path))
+
+        self.f = open(path, 'a')
+        self.pending = 0
+        self.synced = time.monotonic()
+
+    def replay(self, out_data):
+        # later records win, so a re-generated prediction replaces the earlier one
+        for record in self.replayed.pop(out_data['sample_id'], []):
+            if record['qa_index'] >= len(out_data['qa']):
+                continue
+            qa = out_data['qa'][record['qa_index']]
+            qa[record['prediction_key']] = record['prediction']
+            if record.get('context') is not None:
+                qa[record['prediction_key'] + '_context'] = record['context']
+        return out_data
+
+    def log_predictions(self, out_data, prediction_key, qa_idxs, latency=None, tokens=None):
+
+        for idx in qa_idxs:
+            qa = out_data['qa'][idx]
+            if prediction_key not in qa:
+                continue
+            self.f.write(json.dumps({'sample_id': out_data['sample_id'],
+                                     'qa_index': idx,
+                                     'prediction_key': prediction_key,
+                                     'prediction': qa[prediction_key],
+                                     'context': qa.get(prediction_key + '_context'),
+                                     'latency': None if latency is None else round(latency, 3),
+                                     'tokens': tokens}) + '\n')
+            self.pending += 1
+
+        self.f.flush()
+        if self.pending >= self.fsync_every or time.monotonic() - self.synced >= self.fsync_seconds:
+            self.sync()
+
+    def log_request(self, request):
+        # on_done callback of RequestScheduler.run
+        self.log_predictions(request.out_data, request.prediction_key, request.qa_idxs, request.latency, request.num_tokens)
+
+    def sync(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.pending = 0
+        self.synced = time.monotonic()
+
+    def close(self):
+        if not self.f.closed:
+            self.sync()
+            self.f.close()
+
+    def remove(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -5,62 +5,99 @@ sys.path.insert(0, str(Path(__file__).parent.parent))
 
 import time
 import os, json
-import torch
+import hashlib
+from functools import lru_cache
+from collections import OrderedDict
 from tqdm import tqdm
 from global_methods import get_openai_embedding, set_openai_key, run_chatgpt_with_examples
+from task_eval.data_utils import get_conversation
+from task_eval.store_utils import load_database, append_to_embedding_store
 
 # --- BM25S RAG utilities ---
-import bm25s
+# torch and bm25s are imported by the functions that use them, so that the fusion and helper
+# functions can be imported cheaply
 import numpy as np
 
+# in-process LRU cache of bm25s indexes, see get_bm25s_index; a sweep builds one per conversation
+# and rag mode, so only the most recently used ones are kept
+MAX_CACHED_BM25S_INDEXES = 16
+_BM25S_INDEXES = OrderedDict()
 
-def _turn_text(dialog: dict, date_time_string: str) -> str:
+# loaded retrieval encoders keyed by (retriever, mode), see get_encoder
+_ENCODERS = {}
+
+# bm25s indexes over arbitrary context lists keyed by content hash, see get_bm25s_text_index
+_BM25S_TEXT_INDEXES = {}
+
+# retrieval results of the current conversation, see get_rag_retrieval
+_RAG_RETRIEVAL = {}
+
+# 'hybrid-<dense retriever>' fuses bm25s with that dense retriever; plain 'hybrid' uses this one
+HYBRID_DENSE_RETRIEVER = 'contriever'
+RRF_K = 60
+
+
+def get_bm25s_turn_text(dialog: dict, date_time_string: str) -> str:
+    # text of a dialog turn in bm25s indexes; evaluate_retrieval.py indexes the same text
     txt = dialog.get('compressed_text', dialog.get('clean_text', dialog.get('text', '')))
     turn = f'{dialog.get("speaker", "Someone")} said, "{txt}"'
     if dialog.get("img_file") and dialog.get("blip_caption"):
         turn += f' and shared {dialog["blip_caption"]}.'
-    return f'({date_time_string}) {turn}'
+    return get_bm25s_entry_text(turn, date_time_string)
+
+
+def get_bm25s_entry_text(text: str, date_time_string: str) -> str:
+    # text of a summary or observation in bm25s indexes
+    return f'({date_time_string}) {text}'
+
+
+def get_database_bm25s_texts(date_times, contexts):
+    # bm25s side of hybrid retrieval, over the entries of an embedding database
+    return [date_time + ': ' + context for date_time, context in zip(date_times, contexts)]
+
+
+@lru_cache(maxsize=None)
+def get_stemmer(use_stemmer: bool = False):
+    if not use_stemmer:
+        return None
+    try:
+        import Stemmer
+        return Stemmer.Stemmer("english")
+    except Exception:
+        return None
 
 
 def build_bm25s_index_from_data(conversation: dict, method: str = "lucene", mode: str = "dialog",
                                 use_english_stopwords: bool = True, use_stemmer: bool = False):
+    import bm25s
     doc_texts, doc_ids = [], []
-    session_nums = [int(k.split('_')[-1]) for k in conversation.keys()
-                    if k.startswith('session_') and not k.endswith('_date_time')]
-    for i in sorted(session_nums):
-        dt = conversation.get(f'session_{i}_date_time', '')
+    for session in get_conversation(conversation).sessions:
+        i, dt = session.num, session.date_time or ''
         # for dialog in conversation.get(f'session_{i}', []):
         #     t = _turn_text(dialog, dt)
         #     doc_texts.append(t)
         #     doc_ids.append(dialog.get("dia_id", ""))
 
         if mode == "dialog":
-            for dialog in conversation.get(f'session_{i}', []):
-                t = _turn_text(dialog, dt)
+            for turn in session.turns:
+                t = get_bm25s_turn_text(turn.raw, dt)
                 doc_texts.append(t)
-                doc_ids.append(dialog.get("dia_id", ""))
+                doc_ids.append(turn.dia_id or "")
 
         elif mode == "summary":
             # 假设对话里有每个 session 的摘要字段（若没有就跳过/自行填充）
             summ = conversation.get(f'session_{i}_summary')
             if summ:
-                doc_texts.append(f"({dt}) {summ}")
+                doc_texts.append(get_bm25s_entry_text(summ, dt))
             doc_ids.append(f"session_{i}")
 
         elif mode == "observation":
             # 若数据里有 observation 列表，按需拼接
             for obs in conversation.get(f'session_{i}_observations', []):
-                doc_texts.append(f"({dt}) {obs}")
+                doc_texts.append(get_bm25s_entry_text(obs, dt))
             doc_ids.append(f"obs_{i}_{len(doc_ids)}")
 
-    stemmer = None
-    if use_stemmer:
-        try:
-            import Stemmer
-            stemmer = Stemmer.Stemmer("english")
-        except Exception:
-            stemmer = None
-
+    stemmer = get_stemmer(use_stemmer)
     stopwords = "en" if use_english_stopwords else []
     corpus_tokens = bm25s.tokenize(doc_texts, stopwords=stopwords, stemmer=stemmer)
 
@@ -71,17 +108,211 @@ def build_bm25s_index_from_data(conversation: dict, method: str = "lucene", mode
 
 def bm25s_retrieve_topk(retriever, query: str, doc_texts, doc_ids, top_k: int,
                         use_english_stopwords: bool = True, use_stemmer: bool = False):
-    stemmer = None
-    if use_stemmer:
-        try:
-            import Stemmer
-            stemmer = Stemmer.Stemmer("english")
-        except Exception:
-            stemmer = None
+    import bm25s
+    stemmer = get_stemmer(use_stemmer)
     q_tokens = bm25s.tokenize(query, stopwords=("en" if use_english_stopwords else []), stemmer=stemmer)
     idxs, scores = retriever.retrieve(q_tokens, k=top_k)
     idxs, scores = idxs[0], scores[0]
-    return [{"id": doc_ids[i], "text": doc_texts[i], "score": float(scores[j])} for j, i in enumerate(idxs)]
+    return [{"id": doc_ids[i], "text": doc_texts[i], "score": float(scores[j]), "position": int(i)} for j, i in enumerate(idxs)]
+
+
+def get_bm25s_index(conversation: dict, sample_id: str, method: str = "lucene", mode: str = "dialog",
+                    use_english_stopwords: bool = True, use_stemmer: bool = False, index_dir: str = ""):
+    """
+    Returns (retriever, doc_texts, doc_ids) for a conversation, building the bm25s index at most once per
+    (sample_id, rag mode, tokenizer/stemmer settings, conversation content). If index_dir is set, indexes are
+    saved there with bm25s and loaded again in later runs.
+    """
+
+    import bm25s
+
+    content_hash = hashlib.sha1(json.dumps(conversation, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    # key on the stemmer actually used; PyStemmer may be missing even if requested
+    stemmed = get_stemmer(use_stemmer) is not None
+    key = (sample_id, mode, method, use_english_stopwords, stemmed, content_hash)
+    if key in _BM25S_INDEXES:
+        _BM25S_INDEXES.move_to_end(key)
+        return _BM25S_INDEXES[key]
+
+    index_path = None
+    if index_dir:
+        index_path = os.path.join(index_dir, 'bm25s_%s_%s_%s_%s_%s_%s' % (sample_id, mode, method,
+                                                                         'stop' if use_english_stopwords else 'nostop',
+                                                                         'stem' if stemmed else 'nostem', content_hash))
+
+    if index_path is not None and os.path.exists(os.path.join(index_path, 'docs.json')):
+        retriever = bm25s.BM25.load(index_path)
+        docs = json.load(open(os.path.join(index_path, 'docs.json')))
+        doc_texts, doc_ids = docs['doc_texts'], docs['doc_ids']
+    else:
+        retriever, doc_texts, doc_ids = build_bm25s_index_from_data(conversation, method=method, mode=mode,
+                                                                    use_english_stopwords=use_english_stopwords,
+                                                                    use_stemmer=use_stemmer)
+        if index_path is not None:
+            retriever.save(index_path)
+            with open(os.path.join(index_path, 'docs.json'), 'w') as f:
+                json.dump({'doc_texts': doc_texts, 'doc_ids': doc_ids}, f)
+
+    _BM25S_INDEXES[key] = (retriever, doc_texts, doc_ids)
+    if len(_BM25S_INDEXES) > MAX_CACHED_BM25S_INDEXES:
+        _BM25S_INDEXES.popitem(last=False)
+    return retriever, doc_texts, doc_ids
+
+
+def get_bm25s_text_index(texts, method: str = "lucene", use_english_stopwords: bool = True, use_stemmer: bool = False):
+    import bm25s
+
+    # same settings as build_bm25s_index_from_data, over a given list of contexts (e.g. an embedding database)
+    content_hash = hashlib.sha1(json.dumps(texts).encode('utf-8')).hexdigest()
+    key = (method, use_english_stopwords, get_stemmer(use_stemmer) is not None, content_hash)
+    if key not in _BM25S_TEXT_INDEXES:
+        corpus_tokens = bm25s.tokenize(texts, stopwords="en" if use_english_stopwords else [], stemmer=get_stemmer(use_stemmer))
+        retriever = bm25s.BM25(method=method)
+        retriever.index(corpus_tokens)
+        _BM25S_TEXT_INDEXES.clear() # one conversation at a time
+        _BM25S_TEXT_INDEXES[key] = retriever
+    return _BM25S_TEXT_INDEXES[key]
+
+
+def bm25s_score_matrix(retriever, queries, num_docs, use_english_stopwords: bool = True, use_stemmer: bool = False):
+    import bm25s
+
+    # (num_queries, num_docs) bm25 scores, all queries retrieved in one call
+    q_tokens = bm25s.tokenize(queries, stopwords=("en" if use_english_stopwords else []), stemmer=get_stemmer(use_stemmer))
+    idxs, scores = retriever.retrieve(q_tokens, k=num_docs)
+    score_matrix = np.zeros((len(queries), num_docs), dtype=np.float32)
+    np.put_along_axis(score_matrix, idxs, scores, axis=1)
+    return score_matrix
+
+
+def is_hybrid_retriever(retriever):
+    return retriever == 'hybrid' or retriever.startswith('hybrid-')
+
+
+def get_dense_retriever(retriever):
+    if retriever == 'hybrid':
+        return HYBRID_DENSE_RETRIEVER
+    if retriever.startswith('hybrid-'):
+        return retriever[len('hybrid-'):]
+    return retriever
+
+
+def fuse_scores(score_matrices, method='rrf', weights=None, rrf_k=RRF_K):
+    """
+    Fuses (num_queries, num_docs) score matrices of several retrievers into one.
+    'rrf' sums weight / (rrf_k + rank) over retrievers (rank starting at 1); 'weighted' sums the
+    weighted scores after min-max normalizing each query row of each retriever.
+    """
+
+    weights = weights if weights is not None else [1.0] * len(score_matrices)
+    fused = np.zeros(score_matrices[0].shape, dtype=np.float32)
+    for scores, weight in zip(score_matrices, weights):
+        if method == 'rrf':
+            ranks = np.empty(scores.shape, dtype=np.int64)
+            np.put_along_axis(ranks, np.argsort(-scores, axis=1, kind='stable'), np.arange(scores.shape[1])[None, :], axis=1)
+            fused += weight / (rrf_k + 1 + ranks)
+        elif method == 'weighted':
+            low, high = scores.min(axis=1, keepdims=True), scores.max(axis=1, keepdims=True)
+            fused += weight * (scores - low) / np.maximum(high - low, 1e-9)
+        else:
+            raise ValueError("Unknown fusion method %s" % method)
+    return fused
+
+
+def prepare_for_rag(args, data):
+
+    dataset_prefix = os.path.splitext(os.path.split(args.data_file)[-1])[0]
+    database_names = {'summary': 'session_summary', 'dialog': 'dialog', 'observation': 'observation'}
+    if args.rag_mode not in database_names:
+        raise ValueError
+
+    # all samples of a dataset share one memory-mapped store per database; per-sample pickles are still read if present
+    store_path = os.path.join(args.emb_dir, '%s_%s' % (dataset_prefix, database_names[args.rag_mode]))
+    pickle_file = os.path.join(args.emb_dir, '%s_%s_%s.pkl' % (dataset_prefix, database_names[args.rag_mode], data['sample_id']))
+    database = load_database(store_path, data['sample_id'], pickle_file)
+
+    if args.rag_mode == "summary":
+
+        # check if embeddings exist
+        assert database is not None, "Summaries and embeddings do not exist for %s" % data['sample_id']
+
+    elif args.rag_mode == 'dialog':
+        # check if embeddings exist
+        if database is None:
+
+            turns = get_conversation(data['conversation']).turns()
+            dialogs = [turn.rag_text() for turn in turns]
+            date_times = [turn.session.date_time for turn in turns]
+            context_ids = [turn.dia_id for turn in turns]
+
+            print("Getting embeddings for %s dialogs" % len(dialogs))
+            embeddings = get_embeddings(args.retriever, dialogs, 'context')
+            assert embeddings.shape[0] == len(dialogs), "Lengths of embeddings and dialogs do not match"
+            database = {'embeddings': embeddings,
+                             'date_time': date_times,
+                             'dia_id': context_ids,
+                             'context': dialogs}
+
+            append_to_embedding_store(store_path, data['sample_id'], database)
+
+    elif args.rag_mode == 'observation':
+        
+        # check if embeddings exist
+        assert database is not None, "Observations and embeddings do not exist for %s" % data['sample_id']
+
+    
+    print("Getting embeddings for %s questions" % len(data['qa']))
+    question_embeddings = get_embeddings(args.retriever, [q['question'] for q in data['qa']], 'query')
+
+    return database, question_embeddings
+
+
+def get_top_k_indices(scores, top_k):
+
+    # scores: (num_queries, num_contexts); only the top_k columns of each row are sorted
+    num_contexts = scores.shape[1]
+    top_k = min(top_k, num_contexts)
+    if top_k < num_contexts:
+        idxs = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+    else:
+        idxs = np.tile(np.arange(num_contexts), (scores.shape[0], 1))
+    order = np.argsort(-np.take_along_axis(scores, idxs, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(idxs, order, axis=1)
+
+
+def get_context_ids(context_database, top_idxs):
+
+    sorted_context_ids = []
+    for idx in top_idxs:
+        context_id = context_database['dia_id'][idx]
+        if type(context_id) == str:
+            if ',' in context_id:
+                context_id = [s.strip() for s in context_id.split(',')]
+        if type(context_id) == list:
+            sorted_context_ids.extend(context_id)
+        else:
+            sorted_context_ids.append(context_id)
+    return sorted_context_ids
+
+
+def get_rag_retrieval(args, data):
+
+    # retrieval for a top-k sweep runs once per conversation at the largest k;
+    # smaller k are prefixes of the sorted result
+    max_top_k = getattr(args, 'max_top_k', args.top_k)
+    key = (data['sample_id'], args.rag_mode, args.retriever, args.emb_dir, max_top_k,
+           getattr(args, 'fusion', 'rrf'), getattr(args, 'hybrid_weight', 0.5))
+    if key not in _RAG_RETRIEVAL:
+        _RAG_RETRIEVAL.clear() # keep only the conversation being evaluated
+        context_database, query_vectors = prepare_for_rag(args, data)
+        scores = np.dot(np.atleast_2d(query_vectors), context_database['embeddings'].T)
+        if is_hybrid_retriever(args.retriever):
+            # bm25s over the same database entries, fused with the dense scores
+            texts = get_database_bm25s_texts(context_database['date_time'], context_database['context'])
+            bm25_scores = bm25s_score_matrix(get_bm25s_text_index(texts), [q['question'] for q in data['qa']], len(texts))
+            scores = fuse_scores([scores, bm25_scores], args.fusion, [args.hybrid_weight, 1 - args.hybrid_weight])
+        _RAG_RETRIEVAL[key] = (context_database, get_top_k_indices(scores, max_top_k))
+    return _RAG_RETRIEVAL[key]
 
 
 def save_eval(data_file, accs, key='exact_match'):
@@ -105,12 +336,18 @@ def mean_pooling(token_embeddings, mask):
     return sentence_embeddings
 
 
+def get_device():
+    import torch
+    return "cuda:0" if torch.cuda.is_available() else "cpu"
+
+
 def init_context_model(retriever):
+    device = get_device()
     if retriever == 'dpr':
         from transformers import DPRConfig, DPRContextEncoder, DPRQuestionEncoder, DPRQuestionEncoderTokenizer, \
             DPRContextEncoderTokenizer
         context_tokenizer = DPRContextEncoderTokenizer.from_pretrained("facebook/dpr-ctx_encoder-single-nq-base")
-        context_model = DPRContextEncoder.from_pretrained("facebook/dpr-ctx_encoder-single-nq-base").cuda()
+        context_model = DPRContextEncoder.from_pretrained("facebook/dpr-ctx_encoder-single-nq-base").to(device)
         context_model.eval()
         return context_tokenizer, context_model
 
@@ -118,7 +355,7 @@ def init_context_model(retriever):
 
         from transformers import AutoTokenizer, AutoModel
         context_tokenizer = AutoTokenizer.from_pretrained('facebook/contriever')
-        context_model = AutoModel.from_pretrained('facebook/contriever').cuda()
+        context_model = AutoModel.from_pretrained('facebook/contriever').to(device)
         context_model.eval()
         return context_tokenizer, context_model
 
@@ -126,7 +363,8 @@ def init_context_model(retriever):
 
         from transformers import AutoTokenizer, AutoModel
         context_tokenizer = AutoTokenizer.from_pretrained('facebook/dragon-plus-query-encoder')
-        context_model = AutoModel.from_pretrained('facebook/dragon-plus-context-encoder').cuda()
+        context_model = AutoModel.from_pretrained('facebook/dragon-plus-context-encoder').to(device)
+        context_model.eval()
         return context_tokenizer, context_model
 
     elif retriever == 'openai':
@@ -142,19 +380,20 @@ def init_context_model(retriever):
 
 
 def init_query_model(retriever):
+    device = get_device()
     if retriever == 'dpr':
         from transformers import DPRConfig, DPRContextEncoder, DPRQuestionEncoder, DPRQuestionEncoderTokenizer, \
             DPRContextEncoderTokenizer
         question_tokenizer = DPRQuestionEncoderTokenizer.from_pretrained("facebook/dpr-question_encoder-single-nq-base")
-        question_model = DPRQuestionEncoder.from_pretrained("facebook/dpr-question_encoder-single-nq-base").cuda()
+        question_model = DPRQuestionEncoder.from_pretrained("facebook/dpr-question_encoder-single-nq-base").to(device)
         question_model.eval()
         return question_tokenizer, question_model
 
     elif retriever == 'contriever':
 
         from transformers import AutoTokenizer, AutoModel
-        question_tokenizer = context_tokenizer
-        question_model = AutoModel.from_pretrained('facebook/contriever').cuda()
+        question_tokenizer = AutoTokenizer.from_pretrained('facebook/contriever')
+        question_model = AutoModel.from_pretrained('facebook/contriever').to(device)
         question_model.eval()
         return question_tokenizer, question_model
 
@@ -162,7 +401,8 @@ def init_query_model(retriever):
 
         from transformers import AutoTokenizer, AutoModel
         context_tokenizer = AutoTokenizer.from_pretrained('facebook/dragon-plus-query-encoder')
-        question_model = AutoModel.from_pretrained('facebook/dragon-plus-query-encoder').cuda()
+        question_model = AutoModel.from_pretrained('facebook/dragon-plus-query-encoder').to(device)
+        question_model.eval()
         question_tokenizer = context_tokenizer
         return question_tokenizer, question_model
 
@@ -178,30 +418,49 @@ def init_query_model(retriever):
         raise ValueError
 
 
+def get_encoder(retriever, mode='context'):
+    """
+    Process-wide registry of retrieval encoders. Each (retriever, mode) model is loaded on first use
+    and the same tokenizer/model pair is returned afterwards.
+    """
+    # contriever uses the same weights for contexts and queries
+    if retriever == 'contriever':
+        mode = 'context'
+    key = (retriever, mode)
+    if key not in _ENCODERS:
+        if mode == 'context':
+            _ENCODERS[key] = init_context_model(retriever)
+        else:
+            _ENCODERS[key] = init_query_model(retriever)
+    return _ENCODERS[key]
+
+
 def get_embeddings(retriever, inputs, mode='context'):
-    if mode == 'context':
-        tokenizer, encoder = init_context_model(retriever)
-    else:
-        tokenizer, encoder = init_query_model(retriever)
+    import torch
+    retriever = get_dense_retriever(retriever)
+    if retriever == 'openai':
+        # the embedding client does its own request batching
+        set_openai_key()
+        return get_openai_embedding(inputs)
+
+    tokenizer, encoder = get_encoder(retriever, mode)
 
     all_embeddings = []
     batch_size = 24
-    device = "cuda:0" if torch.cuda.is_available() else "cpu"
+    device = encoder.device if encoder is not None else "cpu"
     with torch.no_grad():
         for i in tqdm(range(0, len(inputs), batch_size)):
             # print(input_ids.shape)
             if retriever == 'dpr':
-                input_ids = tokenizer(inputs[i:(i + batch_size)], return_tensors="pt", padding=True)["input_ids"].cuda()
+                input_ids = tokenizer(inputs[i:(i + batch_size)], return_tensors="pt", padding=True)["input_ids"].to(device)
                 embeddings = encoder(input_ids).pooler_output.detach()
                 # print(embeddings.shape)
                 all_embeddings.append(torch.nn.functional.normalize(embeddings, dim=-1))
             elif retriever == 'contriever':
                 # Compute token embeddings
-                ctx_input = tokenizer(inputs[i:(i + batch_size)], padding=True, truncation=True, return_tensors='pt')
-                # print(ctx_input.keys())
-                # input_ids = context_tokenizer(contexts, return_tensors="pt", padding=True)["input_ids"].cuda()
+                ctx_input = tokenizer(inputs[i:(i + batch_size)], padding=True, truncation=True, return_tensors='pt').to(device)
                 outputs = encoder(**ctx_input)
-                embeddings = mean_pooling(outputs[0], inputs['attention_mask'])
+                embeddings = mean_pooling(outputs[0], ctx_input['attention_mask'])
                 all_embeddings.append(torch.nn.functional.normalize(embeddings, dim=-1))
             elif retriever == 'dragon':
                 ctx_input = tokenizer(inputs[i:(i + batch_size)], padding=True, truncation=True,
@@ -209,8 +468,6 @@ def get_embeddings(retriever, inputs, mode='context'):
                 embeddings = encoder(**ctx_input).last_hidden_state[:, 0, :]
                 # all_embeddings.append(torch.nn.functional.normalize(embeddings, dim=-1))
                 all_embeddings.append(embeddings)
-            elif retriever == 'openai':
-                all_embeddings.append(torch.tensor(get_openai_embedding(inputs)))
             else:
                 raise ValueError
 
@@ -218,6 +475,7 @@ def get_embeddings(retriever, inputs, mode='context'):
 
 
 def get_context_embeddings(retriever, data, context_tokenizer, context_encoder, captions=None):
+    import torch
     context_embeddings = []
     context_ids = []
     for i in tqdm(range(1, 20), desc="Getting context encodings"):
@@ -0,0 +1,126 @@
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+
+
+class QARequest(object):
+    """
+    One blocking API call and the function that writes its result back into the output data.
+    num_tokens is the estimated prompt + completion size used for the tokens-per-minute budget;
+    out_data, prediction_key and qa_idxs say which predictions finish() writes.
+    """
+
+    def __init__(self, call, finish, num_tokens=0, out_data=None, prediction_key=None, qa_idxs=()):
+        self.call = call
+        self.finish = finish
+        self.num_tokens = num_tokens
+        self.out_data = out_data
+        self.prediction_key = prediction_key
+        self.qa_idxs = qa_idxs
+        self.latency = None
+
+
+class TokenBucket(object):
+    """
+    Token bucket refilled continuously at `per_minute` units per minute; a budget <= 0 means unlimited.
+    """
+
+    def __init__(self, per_minute=0):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+        self.lock = None
+
+    async def acquire(self, amount=1):
+
+        if self.capacity <= 0:
+            return
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        # a request larger than the whole budget waits for a full bucket instead of forever
+        amount = min(amount, self.capacity)
+        # waiters are served in arrival order
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+class RequestScheduler(object):
+    """
+    Runs QARequests with up to max_in_flight concurrent calls, within requests-per-minute and
+    tokens-per-minute budgets. Each result is written back as soon as its call returns, then passed
+    to the optional on_done(request) callback. After a call fails, requests that have not started
+    are skipped and the failure is raised once the running calls are done.
+    """
+
+    def __init__(self, max_in_flight=4, requests_per_minute=0, tokens_per_minute=0):
+        self.max_in_flight = max(1, max_in_flight)
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+
+    async def _run_all(self, requests, on_done):
+
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+        request_bucket = TokenBucket(self.requests_per_minute)
+        token_bucket = TokenBucket(self.tokens_per_minute)
+        progress = tqdm(total=len(requests), desc='Generating answers')
+        cancelled = []
+
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+
+            async def run_one(request):
+                async with semaphore:
+                    # budgets are taken once a slot is free, so requests queued on the semaphore
+                    # do not use up permits and then fire in a burst
+                    if cancelled:
+                        return
+                    await request_bucket.acquire(1)
+                    await token_bucket.acquire(request.num_tokens)
+                    if cancelled:
+                        return
+                    start = time.monotonic()
+                    try:
+                        result = await loop.run_in_executor(executor, request.call)
+                    except BaseException:
+                        # requests that have not started are skipped after the first failure
+                        cancelled.append(request)
+                        raise
+                    request.latency = time.monotonic() - start
+                progress.update(1)
+                # write-backs run on the event loop thread, one at a time
+                request.finish(result)
+                if on_done is not None:
+                    on_done(request)
+
+            results = await asyncio.gather(*[run_one(request) for request in requests], return_exceptions=True)
+
+        progress.close()
+        return results
+
+    def run(self, requests, on_done=None):
+
+        if len(requests) == 0:
+            return
+        results = asyncio.run(self._run_all(requests, on_done))
+
+        # requests that finished have been written back, the rest were not started; surface the first failure
+        failures = [result for result in results if isinstance(result, BaseException)]
+        if len(failures) > 0:
+            print("%s of %s requests failed, %s were not started" % (len(failures), len(requests),
+                  len([request for request in requests if request.latency is None]) - len(failures)))
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
@@ -0,0 +1,146 @@
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import os, json
+import struct
+import numpy as np
+
+
+# On-disk embedding store shared by several sample databases:
+#   <path>.npy         float32 matrix with the embeddings of all samples, opened with mmap
+#   <path>.meta.jsonl  header line, then one line per sample: "<sample_id>\t<json columns>"
+# Samples are appended in place; if a sample is written again, its latest line wins.
+
+STORE_VERSION = 1
+STORE_DTYPE = '<f4'
+NPY_HEADER_LEN = 128 # fixed so that the shape can be rewritten in place when appending
+
+_STORES = {}
+
+
+def _write_npy_header(f, num_rows, dim):
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d, %d), }" % (STORE_DTYPE, num_rows, dim)
+    header = header.ljust(NPY_HEADER_LEN - 11) + '\n'
+    f.seek(0)
+    f.write(b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1'))
+
+
+def _pack_columns(database, offset):
+    # date_time repeats for every entry of a session, keep a table of unique values instead
+    date_times, date_time_idx, lookup = [], [], {}
+    for date_time in database['date_time']:
+        if date_time not in lookup:
+            lookup[date_time] = len(date_times)
+            date_times.append(date_time)
+        date_time_idx.append(lookup[date_time])
+    return {'offset': offset,
+            'count': len(database['context']),
+            'date_times': date_times,
+            'date_time_idx': date_time_idx,
+            'dia_id': database['dia_id'],
+            'context': database['context']}
+
+
+def store_exists(path):
+    return os.path.exists(path + '.npy') and os.path.exists(path + '.meta.jsonl')
+
+
+def append_to_embedding_store(path, sample_id, database):
+
+    embeddings = np.ascontiguousarray(database['embeddings'], dtype=STORE_DTYPE)
+    assert embeddings.ndim == 2 and embeddings.shape[0] == len(database['context']), "Lengths of embeddings and contexts do not match"
+
+    if store_exists(path):
+        meta_header = json.loads(open(path + '.meta.jsonl').readline())
+        assert meta_header['version'] == STORE_VERSION, "Unsupported embedding store version %s" % meta_header['version']
+        assert meta_header['dim'] == embeddings.shape[1], "Embedding dimension does not match the store"
+        num_rows = (os.path.getsize(path + '.npy') - NPY_HEADER_LEN) // (4 * embeddings.shape[1])
+    else:
+        with open(path + '.npy', 'wb') as f:
+            _write_npy_header(f, 0, embeddings.shape[1])
+        with open(path + '.meta.jsonl', 'w') as f:
+            f.write(json.dumps({'version': STORE_VERSION, 'dim': embeddings.shape[1], 'dtype': STORE_DTYPE}) + '\n')
+        num_rows = 0
+
+    # rows first, then the header with the new shape, then the metadata line that makes them visible
+    with open(path + '.npy', 'r+b') as f:
+        f.seek(NPY_HEADER_LEN + num_rows * 4 * embeddings.shape[1])
+        f.write(embeddings.tobytes())
+        _write_npy_header(f, num_rows + embeddings.shape[0], embeddings.shape[1])
+    with open(path + '.meta.jsonl', 'a') as f:
+        f.write(sample_id + '\t' + json.dumps(_pack_columns(database, num_rows)) + '\n')
+
+    _STORES.pop(path, None)
+
+
+def compact_embedding_store(path):
+
+    # drop rows of samples that were written again later
+    store = EmbeddingStore(path)
+    databases = [(sample_id, store.get_database(sample_id)) for sample_id in store.sample_ids()]
+    tmp_path = path + '.tmp'
+    for ext in ['.npy', '.meta.jsonl']:
+        if os.path.exists(tmp_path + ext):
+            os.remove(tmp_path + ext)
+    for sample_id, database in databases:
+        append_to_embedding_store(tmp_path, sample_id, database)
+    del store, databases
+    for ext in ['.npy', '.meta.jsonl']:
+        os.replace(tmp_path + ext, path + ext)
+    _STORES.pop(path, None)
+
+
+class EmbeddingStore(object):
+    """
+    Read-only view of an embedding store. The matrix is memory-mapped and per-sample metadata is
+    parsed only when that sample is requested.
+    """
+
+    def __init__(self, path):
+
+        self.path = path
+        self.embeddings = np.load(path + '.npy', mmap_mode='r')
+        self._lines = {}
+        with open(path + '.meta.jsonl') as f:
+            self.header = json.loads(f.readline())
+            assert self.header['version'] == STORE_VERSION, "Unsupported embedding store version %s" % self.header['version']
+            for line in f:
+                sample_id, columns = line.rstrip('\n').split('\t', 1)
+                self._lines[sample_id] = columns
+
+    def sample_ids(self):
+        return list(self._lines.keys())
+
+    def __contains__(self, sample_id):
+        return sample_id in self._lines
+
+    def get_database(self, sample_id):
+
+        columns = json.loads(self._lines[sample_id])
+        start = columns['offset']
+        return {'embeddings': self.embeddings[start:start + columns['count']],
+                'date_time': [columns['date_times'][i] for i in columns['date_time_idx']],
+                'dia_id': columns['dia_id'],
+                'context': columns['context']}
+
+
+def load_embedding_store(path):
+    if path not in _STORES:
+        _STORES[path] = EmbeddingStore(path)
+    return _STORES[path]
+
+
+def load_database(store_path, sample_id, pickle_file=None):
+    """
+    Returns the {embeddings, date_time, dia_id, context} database of a sample from the store at
+    store_path, falling back to a per-sample pickle written by older versions of the scripts.
+    """
+    if store_exists(store_path):
+        store = load_embedding_store(store_path)
+        if sample_id in store:
+            return store.get_database(sample_id)
+    if pickle_file is not None and os.path.exists(pickle_file):
+        import pickle
+        return pickle.load(open(pickle_file, 'rb'))
+    return None
@@ -0,0 +1,133 @@
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import json
+import pytest
+
+pytest.importorskip('regex')
+pytest.importorskip('nltk')
+from task_eval import evaluation
+from task_eval.evaluation import rouge_scores, rouge_batch, get_answer_ids, normalize_answer, ps, \
+    SimpleTokenizer, has_answer, f1, rl, EVAL_CHUNK_LINES
+
+
+ROUGE_METRICS = ['rouge-1', 'rouge-2', 'rouge-l']
+
+# (prediction, reference, [ROUGE-1 F, ROUGE-2 F, ROUGE-L F]) computed with rouge.Rouge().get_scores
+# on the normalized, stemmed answers, as rougel_score did before the native implementation
+ROUGE_CASES = [('7 May 2023', '7 may 2023', [1.0, 1.0, 1.0]),
+               ('The cat sat on the mat', 'a cat on a mat sat', [1.0, 0.333333, 0.75]),
+               ('she went to Paris with her sister', 'her sister and she went to paris', [0.923077, 0.727273, 0.615385]),
+               ('running in the park every morning', 'runs in the park', [0.75, 0.666667, 0.75]),
+               ('No information available', 'Not mentioned in the conversation', [0.0, 0.0, 0.0]),
+               ('a b c b a', 'b a b c', [1.0, 0.5, 1.0])]
+
+WORDS = 'yes no true false refutes supports paris london the cat sat on mat 7 may 2023'.split()
+
+
+def test_rouge_matches_recorded_package_scores():
+
+    for prediction, reference, expected in ROUGE_CASES:
+        scores = rouge_scores(get_answer_ids(prediction), get_answer_ids(reference))
+        assert [round(scores[metric]['f'], 6) for metric in ROUGE_METRICS] == expected, (prediction, reference)
+
+    predictions, references, expected = zip(*ROUGE_CASES)
+    batch = rouge_batch(list(predictions), list(references))
+    assert [[round(batch[metric][i], 6) for metric in ROUGE_METRICS] for i in range(len(ROUGE_CASES))] == list(expected)
+    assert rouge_batch(['the'], ['cat']) == {metric: [0.0] for metric in ROUGE_METRICS}
+
+
+def test_rouge_matches_package():
+
+    rouge = pytest.importorskip('rouge')
+    stem = lambda s: ' '.join([ps.stem(w) for w in normalize_answer(s).split()])
+    cases = [(p, r) for p, r, _ in ROUGE_CASES]
+    cases += [(' '.join(WORDS[i % 7:i % 7 + 2 + i % 5]), ' '.join(WORDS[(3 * i) % 11:(3 * i) % 11 + 1 + i % 4])) for i in range(200)]
+    for prediction, reference in cases:
+        scores = rouge_scores(get_answer_ids(prediction), get_answer_ids(reference))
+        try:
+            expected = rouge.Rouge().get_scores(stem(prediction), stem(reference), avg=True)
+        except ValueError:
+            assert scores is None
+            continue
+        for metric in ROUGE_METRICS:
+            for key in ['f', 'p', 'r']:
+                assert scores[metric][key] == pytest.approx(expected[metric][key], abs=1e-9), (prediction, reference, metric, key)
+
+
+def write_results(path, num_lines, answer_type):
+
+    # fixed, varied lines: list or string answers, some only with an adversarial answer
+    with open(path, 'w') as f:
+        f.write('header\n')
+        for i in range(num_lines):
+            if answer_type == 'list':
+                answer = ['refutes'] if i % 3 == 0 else [WORDS[i % len(WORDS)]]
+            else:
+                answer = WORDS[i % len(WORDS)] + ', ' + WORDS[(i * 7) % len(WORDS)]
+            output = ' '.join([WORDS[(i * k) % len(WORDS)] for k in range(1, 2 + i % 9)])
+            line = {'answer': answer if i % 5 else None, 'adversarial_answer': answer,
+                    'output': [output, 'second output'], 'category': i % 4 + 1}
+            f.write(json.dumps(line) + '\n')
+
+
+def read_results(path):
+    return [json.loads(line) for line in open(path).readlines()[1:]]
+
+
+def get_answer(line):
+    return line['answer'] if line.get('answer') is not None else line['adversarial_answer']
+
+
+# the readlines implementations the chunked evaluators replaced
+
+def old_eval_recall(path):
+    tokenizer = SimpleTokenizer()
+    lines = read_results(path)
+    outputs = [' || '.join(line['output']) for line in lines]
+    hits = sum([has_answer(get_answer(line), output, tokenizer) for line, output in zip(lines, outputs)])
+    return round(hits / len(lines), 4), round(sum([len(o.split()) for o in outputs]) / len(lines), 4)
+
+
+def old_eval_fact_checking(path):
+    tokenizer = SimpleTokenizer()
+    lines = read_results(path)
+    hits = 0
+    for line in lines:
+        answer = get_answer(line)
+        if answer == ["refutes"]:
+            answer = ["refutes", "no", "false"]
+        if answer == ["supports"]:
+            answer = ["supports", "yes", "true"]
+        hits += int(has_answer(answer, line['output'][0], tokenizer))
+    return round(hits / len(lines), 4), round(sum([len(line['output'][0].split()) for line in lines]) / len(lines), 4)
+
+
+def old_eval_dialogue_system(path):
+    lines = read_results(path)
+    f1_scores = [f1(line['output'][0], get_answer(line)) for line in lines]
+    rl_scores = [rl(line['output'][0], get_answer(line)) for line in lines]
+    return (round(sum(f1_scores) / len(lines), 4), round(sum(rl_scores) / len(lines), 4),
+            round(sum([len(line['output'][0].split()) for line in lines]) / len(lines), 4))
+
+
+@pytest.mark.parametrize('name, answer_type, old_eval', [('eval_recall', 'list', old_eval_recall),
+                                                          ('eval_fact_checking', 'list', old_eval_fact_checking),
+                                                          ('eval_dialogue_system', 'str', old_eval_dialogue_system)])
+def test_chunked_evaluators_match_readlines(tmp_path, name, answer_type, old_eval):
+
+    # more lines than one chunk, so the pool path runs
+    path = str(tmp_path / 'results.jsonl')
+    num_lines = EVAL_CHUNK_LINES * 2 + 37
+    write_results(path, num_lines, answer_type)
+    expected = old_eval(path)
+
+    eval_file = getattr(evaluation, name)
+    for num_workers in [1, 2]:
+        result = eval_file(path, num_workers, return_histograms=True)
+        assert result[:-1] == pytest.approx(expected, abs=1e-4), (name, num_workers)
+        histograms = result[-1]
+        assert sorted(histograms) == [1, 2, 3, 4]
+        assert sum([sum(histogram.values()) for histogram in histograms.values()]) == num_lines
+    assert eval_file(path, 2) == pytest.approx(expected, abs=1e-4)
@@ -0,0 +1,66 @@
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import json
+from task_eval.journal_utils import PredictionJournal, get_journal_file, get_pending_idxs, resume_out_data
+
+
+KEY = 'model_prediction'
+
+
+def get_sample():
+    return {'sample_id': 'conv-1',
+            'qa': [{'question': 'q%s' % i, 'answer': 'a%s' % i, 'category': 1} for i in range(4)]}
+
+
+def test_resume_from_journal_with_existing_out_file(tmp_path):
+
+    out_file = str(tmp_path / 'out.json')
+    data = get_sample()
+
+    # an earlier run wrote question 0 to the output file, an interrupted run journaled 1 and 2
+    out_sample = get_sample()
+    out_sample['qa'][0][KEY] = 'a0'
+    with open(out_file, 'w') as f:
+        json.dump([out_sample], f)
+    journal = PredictionJournal(get_journal_file(out_file))
+    out_data = resume_out_data(data, {}, journal)
+    out_data['qa'][1][KEY] = 'a1'
+    out_data['qa'][2][KEY] = 'a2'
+    journal.log_predictions(out_data, KEY, [1, 2])
+    journal.close()
+
+    # restart: the output file is loaded, so out_data does not share dicts with the input data
+    data = get_sample()
+    out_samples = {d['sample_id']: d for d in json.load(open(out_file))}
+    journal = PredictionJournal(get_journal_file(out_file))
+    out_data = resume_out_data(data, out_samples, journal)
+    journal.close()
+
+    assert get_pending_idxs(out_data, KEY) == [3]
+    assert [qa.get(KEY) for qa in out_data['qa']] == ['a0', 'a1', 'a2', None]
+    assert get_pending_idxs(out_data, KEY, overwrite=True) == [0, 1, 2, 3]
+
+
+def test_journal_file_is_never_the_out_file():
+    assert get_journal_file('outputs/locomo10_qa.json') == 'outputs/locomo10_qa_journal.jsonl'
+    assert get_journal_file('outputs/locomo10_qa') == 'outputs/locomo10_qa_journal.jsonl'
+    assert get_journal_file('outputs.json/results') == 'outputs.json/results_journal.jsonl'
+
+
+def test_torn_journal_line_is_dropped(tmp_path):
+
+    path = str(tmp_path / 'out_journal.jsonl')
+    journal = PredictionJournal(path)
+    out_data = get_sample()
+    out_data['qa'][0][KEY] = 'a0'
+    journal.log_predictions(out_data, KEY, [0])
+    journal.close()
+    with open(path, 'a') as f:
+        f.write('{"sample_id": "conv-1", "qa_ind')
+
+    journal = PredictionJournal(path)
+    out_data = journal.replay(get_sample())
+    journal.close()
+    assert get_pending_idxs(out_data, KEY) == [1, 2, 3]